@@ -0,0 +1,220 @@
+"""
+Микробенчмарки горячих путей BitrixDeliveryManager на синтетических данных.
+
+    python -m benchmarks.hot_paths                       # 1k/10k/100k доставок, сравнение с базой
+    python -m benchmarks.hot_paths --scales 1000 10000   # выбранные масштабы
+    python -m benchmarks.hot_paths --save-baseline       # записать результаты как новую базу
+    python -m benchmarks.hot_paths --check               # код возврата 1 при регрессии
+
+Время - минимум по повторам (--repeat), память - пик tracemalloc в отдельном прогоне.
+Запросов в Bitrix нет: кэш генерируется (benchmarks.synthetic), сохраняется
+в хранилище во временном каталоге и загружается менеджером, ссылки на документы
+выборки заранее лежат в document_urls.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import tempfile
+import time
+import tracemalloc
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List
+
+from benchmarks.synthetic import SyntheticConfig, document_urls, generate_cache
+from webservice.src.bitrix_delivery_manager import BitrixDeliveryManager
+from webservice.src.cache_store import make_cache_store
+
+DEFAULT_SCALES = (1000, 10000, 100000)
+BASELINE_FILE = os.path.join(os.path.dirname(__file__), 'baselines', 'hot_paths.json')
+# Поиски по id и телефону меряются пачкой одинакового размера на любом масштабе
+LOOKUPS = 1000
+WEBHOOK_URL = 'http://bitrix.invalid/rest/1/benchmark/'
+
+
+@dataclass
+class Benchmark:
+    name: str
+    run: Callable[[], Any]
+    # Вызывается перед каждым повтором, в замер не входит
+    setup: Callable[[], Any] = lambda: None
+
+
+def _sample(items: List[Any], size: int, seed: int) -> List[Any]:
+    # Ровно size элементов: при нехватке выборка повторяется по кругу
+    sample = random.Random(seed).sample(items, min(size, len(items)))
+    return [sample[i % len(sample)] for i in range(size)] if sample else []
+
+
+def _phone_variants(phone: str) -> List[str]:
+    # Номер в том виде, в каком его вводят водители
+    return ['+' + phone, '8' + phone[1:], f'+{phone[0]} ({phone[1:4]}) {phone[4:7]}-{phone[7:9]}-{phone[9:]}']
+
+
+def prepare_manager(deliveries: int, workdir: str, backend: str = None, seed: int = 42) -> BitrixDeliveryManager:
+    """
+    Менеджер, загруженный из хранилища с синтетическим кэшем на deliveries доставок.
+    """
+    cache = generate_cache(SyntheticConfig.for_deliveries(deliveries, seed=seed))
+    cache_file = os.path.join(workdir, f'bench_{deliveries}.json')
+    make_cache_store(cache_file, backend).save_all(cache)
+    del cache
+    return BitrixDeliveryManager(WEBHOOK_URL, cache_file, force_reload=False, cache_backend=backend)
+
+
+def hot_path_benchmarks(manager: BitrixDeliveryManager, seed: int = 42) -> List[Benchmark]:
+    delivery_ids = _sample(sorted(manager.cache['delivery']), LOOKUPS, seed)
+    phones = [
+        variant
+        for contact in manager.cache['contact'].values()
+        for variant in _phone_variants(contact['PHONE'])
+    ]
+    phones = _sample(phones, LOOKUPS, seed)
+
+    # Ссылки на PDF выборки уже разрешены, как после prefetch_document_urls
+    urls = document_urls(manager.cache)
+    manager.document_urls.maxsize = max(manager.document_urls.maxsize, 2 * len(delivery_ids))
+    for delivery_id in delivery_ids:
+        for name in ('nacladnaya', 'doverennost'):
+            document = manager._first_child(name, delivery_id)
+            if document is not None:
+                key = (name, int(document['id']))
+                manager.document_urls.set(key, urls[key])
+
+    def load_cache_from_file():
+        manager._load_cache_from_file()
+        manager._rebuild_indexes()
+        manager._invalidate_nested()
+        # Хранилище декодирует типы лениво - учитываем декодирование всех типов
+        for _ in manager.cache.items():
+            pass
+
+    def full_info():
+        for delivery_id in delivery_ids:
+            manager.get_delivery_full_info_by_id(delivery_id)
+
+    def driver_by_phone():
+        for phone in phones:
+            manager.get_driver_id_by_phone(phone)
+
+    def warm_indexes():
+        for name in manager.entity_type2parent_id:
+            manager._ensure_index(name)
+        manager._ensure_index('contact')
+
+    return [
+        Benchmark('load_cache_from_file', load_cache_from_file),
+        # Холодная сборка: материализованная структура сброшена, индексы построены
+        Benchmark('build_nested_structure', manager.build_nested_structure,
+                  setup=lambda: (warm_indexes(), manager._invalidate_nested())),
+        Benchmark(f'get_delivery_full_info_by_id x{LOOKUPS}', full_info, setup=warm_indexes),
+        Benchmark('get_deliveries_grouped_by_driver', manager.get_deliveries_grouped_by_driver, setup=warm_indexes),
+        Benchmark(f'get_driver_id_by_phone x{LOOKUPS}', driver_by_phone, setup=warm_indexes),
+    ]
+
+
+def measure(benchmark: Benchmark, repeat: int) -> Dict[str, float]:
+    times = []
+    for _ in range(repeat):
+        benchmark.setup()
+        started = time.perf_counter()
+        benchmark.run()
+        times.append(time.perf_counter() - started)
+
+    benchmark.setup()
+    tracemalloc.start()
+    try:
+        benchmark.run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        'time': min(times),
+        'median': statistics.median(times),
+        'peak_kb': round(peak / 1024, 1)
+    }
+
+
+def run(scales: List[int], repeat: int, backend: str = None, seed: int = 42) -> Dict[str, Dict[str, Dict[str, float]]]:
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for deliveries in scales:
+            print(f"Масштаб {deliveries} доставок: генерация и сохранение...")
+            manager = prepare_manager(deliveries, workdir, backend=backend, seed=seed)
+            results[str(deliveries)] = {
+                benchmark.name: measure(benchmark, repeat)
+                for benchmark in hot_path_benchmarks(manager, seed=seed)
+            }
+            del manager
+    return results
+
+
+def load_baseline(path: str) -> Dict[str, Any]:
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_baseline(path: str, results: Dict[str, Any], repeat: int):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'repeat': repeat,
+            'results': results
+        }, f, ensure_ascii=False, indent=2)
+        f.write('\n')
+
+
+def report(results: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> List[str]:
+    """
+    Печатает таблицу результатов и возвращает замеры, которые по времени или пику памяти
+    хуже базы больше чем в threshold раз.
+    """
+    regressions = []
+    base_results = baseline.get('results', {})
+    print(f"{'доставок':>9}  {'замер':<40} {'время, мс':>11} {'пик, КБ':>11} {'к базе':>8}")
+    for scale, benchmarks in results.items():
+        for name, result in benchmarks.items():
+            base = base_results.get(scale, {}).get(name)
+            ratio = result['time'] / base['time'] if base and base['time'] else None
+            mark = ''
+            if ratio is not None and ratio > threshold:
+                mark = '  <- регрессия'
+                regressions.append(f"{scale}/{name}")
+            elif base and result['peak_kb'] > base['peak_kb'] * threshold + 64:
+                mark = '  <- регрессия памяти'
+                regressions.append(f"{scale}/{name} (память)")
+            print(
+                f"{scale:>9}  {name:<40} {result['time'] * 1000:>11.2f} {result['peak_kb']:>11.1f} "
+                f"{(f'{ratio:.2f}x' if ratio is not None else '-'):>8}{mark}"
+            )
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Микробенчмарки горячих путей BitrixDeliveryManager")
+    parser.add_argument("--scales", type=int, nargs="+", default=list(DEFAULT_SCALES), help="Число доставок")
+    parser.add_argument("--repeat", type=int, default=3, help="Повторов на замер")
+    parser.add_argument("--backend", default=None, help="Хранилище кэша: sqlite, snapshot или json")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="Файл базовых результатов")
+    parser.add_argument("--save-baseline", action="store_true", help="Записать результаты как базу")
+    parser.add_argument("--threshold", type=float, default=1.5, help="Во сколько раз медленнее базы считать регрессией")
+    parser.add_argument("--check", action="store_true", help="Код возврата 1 при регрессии")
+    args = parser.parse_args()
+
+    results = run(args.scales, args.repeat, backend=args.backend, seed=args.seed)
+    regressions = report(results, load_baseline(args.baseline), args.threshold)
+    if args.save_baseline:
+        baseline = load_baseline(args.baseline)
+        save_baseline(args.baseline, {**baseline.get('results', {}), **results}, args.repeat)
+        print(f"База сохранена в {args.baseline}")
+    if regressions:
+        print("Регрессии: " + ", ".join(regressions))
+        if args.check:
+            raise SystemExit(1)
@@ -0,0 +1,442 @@
+"""
+Локальная замена Bitrix REST для офлайн-бенчмарков и отладки синхронизации.
+
+Поддерживает методы, которыми пользуется BitrixDeliveryManager: batch,
+crm.deal.list, crm.item.list, crm.contact.list, crm.item.productrow.list,
+crm.documentgenerator.document.list и crm.item.update. Фильтры, select,
+постраничная выгрузка (start/next/total и start=-1) и формат ответов
+повторяют Bitrix в той мере, в какой на них опирается менеджер.
+Задержка, размер страницы, квота запросов и доля ошибок QUERY_LIMIT_EXCEEDED
+настраиваются; сервер считает запросы по методам и переданные байты.
+
+    with MockBitrix.from_cache(generate_cache(config), latency=0.05) as bitrix:
+        manager = BitrixDeliveryManager(bitrix.webhook_url, cache_file)
+"""
+import bisect
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Iterator, List, Tuple
+from urllib.parse import parse_qsl
+
+from webservice.src.bitrix_client import TokenBucket
+
+ENTITY_TYPE_IDS = {
+    'shipment': 1040,
+    'purchase': 1044,
+    'delivery': 1048,
+    'unloading': 1056,
+    'loading': 1060,
+    'nacladnaya': 1064,
+    'doverennost': 1068
+}
+# Поле даты изменения, на которое Bitrix отображает DATE_MODIFY в фильтре элементов
+_ITEM_DATE_FIELDS = {'DATE_MODIFY': 'updatedTime', 'DATE_CREATE': 'createdTime'}
+_MSK = timezone(timedelta(hours=3))
+_FILTER_OPS = ('>=', '<=', '!=', '>', '<', '=', '%', '!')
+
+
+def parse_php_query(query: str) -> Dict[str, Any]:
+    """
+    Разбирает query string команды batch (filter[id][0]=1) обратно во вложенные
+    параметры; словари с ключами 0..n становятся списками.
+    """
+    root: Dict[str, Any] = {}
+    for key, value in parse_qsl(query, keep_blank_values=True):
+        head, _, rest = key.partition('[')
+        parts = [head] + re.findall(r'([^\[\]]*)\]', '[' + rest if rest else '')
+        node = root
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = value
+
+    def listify(node: Any) -> Any:
+        if not isinstance(node, dict):
+            return node
+        node = {key: listify(value) for key, value in node.items()}
+        if node and all(key.isdigit() for key in node):
+            return [node[key] for key in sorted(node, key=int)]
+        return node
+
+    return listify(root)
+
+
+def _now() -> str:
+    return datetime.now(_MSK).isoformat(timespec='seconds')
+
+
+def _compare_key(value: Any) -> Any:
+    """
+    Ключ сравнения значения поля с фильтром: числа как числа, даты как даты, иначе строки.
+    """
+    if isinstance(value, (int, float)):
+        return value
+    text = '' if value is None else str(value)
+    try:
+        return int(text)
+    except ValueError:
+        pass
+    try:
+        moment = datetime.fromisoformat(text)
+        return moment if moment.tzinfo else moment.replace(tzinfo=_MSK)
+    except ValueError:
+        return text
+
+
+def _field_value(item: Dict[str, Any], field: str) -> Any:
+    if field in item:
+        return item[field]
+    if field in _ITEM_DATE_FIELDS and _ITEM_DATE_FIELDS[field] in item:
+        return item[_ITEM_DATE_FIELDS[field]]
+    for key in item:
+        if key.lower() == field.lower():
+            return item[key]
+    return None
+
+
+def _matches(item: Dict[str, Any], conditions: Dict[str, Any]) -> bool:
+    for key, expected in (conditions or {}).items():
+        op = next((op for op in _FILTER_OPS if key.startswith(op)), '')
+        value = _field_value(item, key[len(op):])
+        # Значение с % без оператора Bitrix тоже сравнивает по подстроке
+        if op == '%' or (not op and isinstance(expected, str) and '%' in expected):
+            if str(expected).strip('%').lower() not in str(value or '').lower():
+                return False
+            continue
+        if isinstance(expected, list) or op in ('', '=', '!', '!='):
+            options = {_compare_key(option) for option in (expected if isinstance(expected, list) else [expected])}
+            if (_compare_key(value) in options) == op.startswith('!'):
+                return False
+            continue
+        left, right = _compare_key(value), _compare_key(expected)
+        try:
+            ok = {'>': left > right, '>=': left >= right, '<': left < right, '<=': left <= right}[op]
+        except TypeError:
+            ok = False
+        if not ok:
+            return False
+    return True
+
+
+def _project(item: Dict[str, Any], select: List[str] | None, id_field: str) -> Dict[str, Any]:
+    if not select or '*' in select:
+        return item
+    return {key: value for key, value in item.items() if key in select or key == id_field}
+
+
+class MockBitrix:
+    """
+    Bitrix REST поверх данных в памяти, HTTP-сервер в фоновом потоке.
+
+    latency - задержка каждого HTTP-запроса, сек; page_size - элементов на страницу
+    (Bitrix всегда отдаёт 50, и менеджер на это рассчитывает); rate/burst - квота
+    запросов в секунду, сверх которой отвечает 503 QUERY_LIMIT_EXCEEDED (0 - без квоты);
+    error_rate - доля запросов, на которые случайно отвечает та же ошибка.
+    """
+    def __init__(
+        self,
+        deals: List[Dict[str, Any]],
+        contacts: List[Dict[str, Any]],
+        items: Dict[int, List[Dict[str, Any]]],
+        product_rows: List[Dict[str, Any]],
+        documents: Dict[int, List[Dict[str, Any]]],
+        latency: float = 0.0,
+        page_size: int = 50,
+        rate: float = 0.0,
+        burst: int = 50,
+        error_rate: float = 0.0,
+        seed: int = 42,
+        host: str = '127.0.0.1',
+        port: int = 0
+    ):
+        self.deals = sorted(deals, key=lambda deal: int(deal['ID']))
+        self.contacts = sorted(contacts, key=lambda contact: int(contact['ID']))
+        self.items = {type_id: sorted(type_items, key=lambda item: int(item['id'])) for type_id, type_items in items.items()}
+        self.product_rows = product_rows
+        self.documents = {type_id: sorted(docs, key=lambda doc: int(doc['id'])) for type_id, docs in documents.items()}
+        self.latency = latency
+        self.page_size = page_size
+        self.limiter = TokenBucket(rate, burst) if rate else None
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.requests: Counter = Counter()
+        self.commands: Counter = Counter()
+        self.errors = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread: threading.Thread | None = None
+        # Индексы фильтров по спискам значений и списки id для >id, по источникам
+        self._indexes: Dict[Tuple[int, str], Dict[Any, List[int]]] = {}
+        self._id_lists: Dict[int, List[int]] = {}
+
+    @classmethod
+    def from_cache(
+        cls,
+        cache: Dict[str, Dict[int, Dict[str, Any]]],
+        document_urls: Dict[Tuple[str, int], str] = None,
+        **kwargs
+    ) -> 'MockBitrix':
+        """
+        Сервер с данными в формате Bitrix, из которых загрузка восстановит cache
+        (например, benchmarks.synthetic.generate_cache).
+        """
+        deals = [dict(deal) for deal in cache['deal'].values()]
+        deals.extend(dict(supply) for supply in cache['supply'].values())
+        contacts = []
+        for contact in cache['contact'].values():
+            phones = contact.get('PHONES') or [contact.get('PHONE')]
+            contacts.append({
+                **{key: value for key, value in contact.items() if key != 'PHONES'},
+                'PHONE': [{'VALUE': '+' + phone, 'VALUE_TYPE': 'WORK'} for phone in phones if phone]
+            })
+        items = {
+            type_id: [dict(item) for item in cache[name].values()]
+            for name, type_id in ENTITY_TYPE_IDS.items()
+        }
+        product_rows = []
+        for delivery_id, rows in cache['product_rows'].items():
+            for row in rows:
+                product_rows.append({
+                    'id': len(product_rows) + 1,
+                    'ownerId': delivery_id,
+                    'ownerType': f"T{hex(ENTITY_TYPE_IDS['delivery'])[2:]}",
+                    'productName': row['product_name'],
+                    'quantity': row['quantity'],
+                    'measureName': row['unit']
+                })
+        documents: Dict[int, List[Dict[str, Any]]] = {}
+        for (name, document_id), url in (document_urls or {}).items():
+            type_id = ENTITY_TYPE_IDS[name]
+            documents.setdefault(type_id, []).append({'id': document_id, 'entityTypeId': type_id, 'pdfUrl': url})
+        return cls(deals, contacts, items, product_rows, documents, **kwargs)
+
+    # --- Сервер ---
+    @property
+    def webhook_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/rest/1/mock/"
+
+    def start(self) -> 'MockBitrix':
+        self._thread = threading.Thread(target=self._server.serve_forever, name='mock-bitrix', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self) -> 'MockBitrix':
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'requests': sum(self.requests.values()),
+                'by_method': dict(self.requests),
+                'commands': dict(self.commands),
+                'errors': self.errors,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out
+            }
+
+    def reset_stats(self):
+        with self._lock:
+            self.requests.clear()
+            self.commands.clear()
+            self.errors = 0
+            self.bytes_in = 0
+            self.bytes_out = 0
+
+    def _handler_class(self) -> type:
+        bitrix = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                method = self.path.rstrip('/').rsplit('/', 1)[-1]
+                try:
+                    params = json.loads(body) if body else {}
+                except ValueError:
+                    params = {}
+                status, payload = bitrix.handle_request(method, params)
+                data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+                with bitrix._lock:
+                    bitrix.bytes_in += len(body)
+                    bitrix.bytes_out += len(data)
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json; charset=utf-8')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    # --- Методы REST ---
+    def handle_request(self, method: str, params: Dict[str, Any]) -> Tuple[int, Dict[str, Any]]:
+        """
+        Обрабатывает HTTP-вызов метода: задержка, квота и случайные ошибки, затем сам метод.
+        """
+        method = method.removesuffix('.json')
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.requests[method] += 1
+            limited = (self.limiter is not None and not self.limiter.try_acquire()) \
+                or (self.error_rate and self._random.random() < self.error_rate)
+            if limited:
+                self.errors += 1
+        if limited:
+            return 503, {'error': 'QUERY_LIMIT_EXCEEDED', 'error_description': 'Too many requests'}
+        if method == 'batch':
+            return 200, self._batch(params)
+        result = self.call(method, params)
+        return (400 if 'error' in result else 200), result
+
+    def _batch(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        payload = {'result': {}, 'result_error': {}, 'result_total': {}, 'result_next': {}, 'result_time': {}}
+        for key, command in (params.get('cmd') or {}).items():
+            method, _, query = command.partition('?')
+            result = self.call(method, parse_php_query(query))
+            if 'error' in result:
+                payload['result_error'][key] = {'error': result['error'], 'error_description': result.get('error_description', '')}
+                continue
+            payload['result'][key] = result['result']
+            if 'total' in result:
+                payload['result_total'][key] = result['total']
+            if 'next' in result:
+                payload['result_next'][key] = result['next']
+        return {'result': payload, 'time': {}}
+
+    def call(self, method: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Выполняет один метод (в том числе команду внутри batch) и возвращает тело ответа Bitrix.
+        """
+        method = method.strip('/').removesuffix('.json')
+        with self._lock:
+            self.commands[method] += 1
+            handler = {
+                'crm.deal.list': lambda: self._list(self.deals, params, 'ID'),
+                'crm.contact.list': lambda: self._list(self.contacts, params, 'ID'),
+                'crm.item.list': lambda: self._list(
+                    self.items.get(int(params.get('entityTypeId') or 0), []), params, 'id', wrap='items'
+                ),
+                'crm.item.productrow.list': lambda: self._list(self.product_rows, params, 'id', wrap='productRows'),
+                'crm.documentgenerator.document.list': lambda: self._documents(params),
+                'crm.item.update': lambda: self._update_item(params),
+            }.get(method)
+            if handler is None:
+                return {'error': 'ERROR_METHOD_NOT_FOUND', 'error_description': f'Method {method} not found'}
+            return handler()
+
+    def _index(self, source: List[Dict[str, Any]], field: str) -> Dict[Any, List[int]]:
+        """
+        Значение поля -> позиции элементов source; строится при первом фильтре по полю.
+        """
+        key = (id(source), field)
+        index = self._indexes.get(key)
+        if index is None:
+            index = {}
+            for position, item in enumerate(source):
+                index.setdefault(_compare_key(_field_value(item, field)), []).append(position)
+            self._indexes[key] = index
+        return index
+
+    def _candidates(self, source: List[Dict[str, Any]], conditions: Dict[str, Any], id_field: str) -> Iterator[Dict[str, Any]]:
+        """
+        Элементы source, среди которых нужно проверять фильтр: по индексу для фильтра
+        по списку значений, двоичным поиском для >id (source отсортирован по id).
+        Порядок - как в source.
+        """
+        for key, expected in conditions.items():
+            if isinstance(expected, list) and not key.startswith('!'):
+                index = self._index(source, key.lstrip('='))
+                positions = sorted({
+                    position for value in expected for position in index.get(_compare_key(value), ())
+                })
+                return (source[position] for position in positions)
+        lower = conditions.get('>' + id_field)
+        if lower is not None:
+            ids = self._id_lists.get(id(source))
+            if ids is None:
+                ids = self._id_lists[id(source)] = [int(item[id_field]) for item in source]
+            return (source[position] for position in range(bisect.bisect_right(ids, int(lower)), len(source)))
+        return iter(source)
+
+    def _list(self, source: List[Dict[str, Any]], params: Dict[str, Any], id_field: str, wrap: str = None) -> Dict[str, Any]:
+        conditions = params.get('filter') or {}
+        matched = (item for item in self._candidates(source, conditions, id_field) if _matches(item, conditions))
+        order = [(field.lower(), str(direction).upper()) for field, direction in (params.get('order') or {}).items()]
+        # Источники и так отсортированы по id по возрастанию
+        if order and order != [(id_field.lower(), 'ASC')]:
+            matched = list(matched)
+            for field, direction in reversed(order):
+                matched.sort(key=lambda item, field=field: _compare_key(_field_value(item, field)), reverse=direction == 'DESC')
+        start = int(params.get('start') or 0)
+        # start=-1: без подсчёта total и без next, как в Bitrix
+        if start < 0:
+            page, total = list(islice(matched, self.page_size)), None
+        else:
+            matched = list(matched)
+            page, total = matched[start:start + self.page_size], len(matched)
+        page = [_project(item, params.get('select'), id_field) for item in page]
+        response = {'result': {wrap: page} if wrap else page}
+        if total is not None:
+            response['total'] = total
+            if start + self.page_size < total:
+                response['next'] = start + self.page_size
+        return response
+
+    def _documents(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        return self._list(self.documents.get(int(params.get('entityTypeId') or 0), []), params, 'id', wrap='documents')
+
+    def _update_item(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        items = self.items.get(int(params.get('entityTypeId') or 0), [])
+        item_id = int(params.get('id') or 0)
+        for item in items:
+            if int(item['id']) == item_id:
+                item.update(params.get('fields') or {})
+                item['updatedTime'] = _now()
+                self._indexes.clear()
+                return {'result': {'item': dict(item)}}
+        return {'error': 'NOT_FOUND', 'error_description': 'Not found'}
+
+    # --- Изменения данных для дельта-синхронизации ---
+    def touch_items(self, name: str, count: int, **fields) -> List[int]:
+        """
+        Изменяет count случайных элементов типа name (fields и updatedTime=сейчас),
+        возвращает их id.
+        """
+        with self._lock:
+            items = self.items[ENTITY_TYPE_IDS[name]]
+            changed = self._random.sample(items, min(count, len(items)))
+            for item in changed:
+                item.update(fields)
+                item['updatedTime'] = _now()
+            self._indexes.clear()
+            return [int(item['id']) for item in changed]
+
+    def touch_contacts(self, count: int) -> List[int]:
+        with self._lock:
+            changed = self._random.sample(self.contacts, min(count, len(self.contacts)))
+            for contact in changed:
+                contact['DATE_MODIFY'] = _now()
+            return [int(contact['ID']) for contact in changed]
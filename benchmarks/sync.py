@@ -0,0 +1,107 @@
+"""
+Сквозной бенчмарк загрузки и дельта-синхронизации против локального MockBitrix.
+
+    python -m benchmarks.sync --deliveries 1000 --latency 0.05
+    python -m benchmarks.sync --deliveries 10000 --client-rate 1000 --error-rate 0.02
+
+Меряются полная загрузка (конструктор менеджера с force_reload), разрешение
+ссылок на документы активных доставок, дельта после изменения части доставок,
+контактов и документов и холостая дельта без изменений: время, HTTP-запросы
+и команды batch по методам, ошибки квоты, байты в обе стороны.
+По умолчанию клиент держит квоту Bitrix (2 запроса/с, всплеск 50), как в проде.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import tempfile
+import time
+from typing import Any, Callable, Dict
+
+from benchmarks.mock_bitrix import MockBitrix
+from benchmarks.synthetic import ACTIVE_DELIVERY_STAGES, SyntheticConfig, document_urls, generate_cache
+from webservice.src.bitrix_delivery_manager import BitrixDeliveryManager
+
+
+def measure(bitrix: MockBitrix, func: Callable[[], Any], verbose: bool = False) -> Dict[str, Any]:
+    bitrix.reset_stats()
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    started = time.perf_counter()
+    with output:
+        func()
+    return {'time': time.perf_counter() - started, **bitrix.stats()}
+
+
+def run(args: argparse.Namespace) -> Dict[str, Dict[str, Any]]:
+    if args.client_rate:
+        os.environ["BITRIX_RATE_LIMIT"] = str(args.client_rate)
+    cache = generate_cache(SyntheticConfig.for_deliveries(args.deliveries, seed=args.seed))
+    bitrix = MockBitrix.from_cache(
+        cache,
+        document_urls(cache),
+        latency=args.latency,
+        page_size=args.page_size,
+        rate=args.rate,
+        error_rate=args.error_rate,
+        seed=args.seed
+    )
+    del cache
+    results = {}
+    with bitrix, tempfile.TemporaryDirectory() as workdir:
+        cache_file = os.path.join(workdir, 'bitrix_cache.json')
+        holder = {}
+
+        def load():
+            holder['manager'] = BitrixDeliveryManager(
+                bitrix.webhook_url, cache_file, force_reload=True, load_concurrency=args.concurrency
+            )
+
+        results['full_load'] = measure(bitrix, load, args.verbose)
+        manager: BitrixDeliveryManager = holder['manager']
+        results['prefetch_document_urls'] = measure(bitrix, manager.prefetch_document_urls, args.verbose)
+
+        # Изменения, которые должна подобрать дельта
+        changed = max(1, int(args.deliveries * args.change_share))
+        for stage in ACTIVE_DELIVERY_STAGES[:2]:
+            bitrix.touch_items('delivery', changed // 2, stageId=stage)
+        bitrix.touch_items('nacladnaya', changed // 4)
+        bitrix.touch_items('loading', changed // 4)
+        bitrix.touch_contacts(max(1, changed // 10))
+        results['delta_refresh'] = measure(bitrix, manager.refresh_updates, args.verbose)
+        results['idle_refresh'] = measure(bitrix, manager.refresh_updates, args.verbose)
+    return results
+
+
+def report(results: Dict[str, Dict[str, Any]]):
+    print(f"{'этап':<24} {'время, с':>9} {'HTTP':>6} {'команд':>7} {'ошибок':>7} {'отправлено, КБ':>15} {'получено, КБ':>13}")
+    for name, result in results.items():
+        print(
+            f"{name:<24} {result['time']:>9.2f} {result['requests']:>6} {sum(result['commands'].values()):>7} "
+            f"{result['errors']:>7} {result['bytes_in'] / 1024:>15.1f} {result['bytes_out'] / 1024:>13.1f}"
+        )
+    for name, result in results.items():
+        commands = ", ".join(f"{method}={count}" for method, count in sorted(result['commands'].items()))
+        print(f"{name}: {commands}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Загрузка и дельта-синхронизация против MockBitrix")
+    parser.add_argument("--deliveries", type=int, default=1000, help="Число доставок в синтетических данных")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--latency", type=float, default=0.02, help="Задержка ответа сервера, сек")
+    parser.add_argument("--page-size", type=int, default=50, help="Элементов на страницу")
+    parser.add_argument("--rate", type=float, default=0.0, help="Квота сервера, запросов/с (0 - без квоты)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Доля ответов QUERY_LIMIT_EXCEEDED")
+    parser.add_argument("--client-rate", type=float, default=None, help="Квота клиента, запросов/с (BITRIX_RATE_LIMIT)")
+    parser.add_argument("--concurrency", type=int, default=None, help="BITRIX_LOAD_CONCURRENCY")
+    parser.add_argument("--change-share", type=float, default=0.05, help="Доля доставок, изменяемых перед дельтой")
+    parser.add_argument("--json", default=None, help="Записать результаты в файл")
+    parser.add_argument("--verbose", action="store_true", help="Не скрывать вывод менеджера")
+    args = parser.parse_args()
+
+    results = run(args)
+    report(results)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
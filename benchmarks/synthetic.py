@@ -0,0 +1,172 @@
+import random
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Tuple
+
+from webservice.src.change_detector import DRIVER_FIELD, NAZNACHENIE_DRIVER_STAGE, SEND_DOCUMENTS_STAGE
+from webservice.src.entity_schema import ROUTE_LIST_FIELD, SUPPLY_DEAL_FIELD
+
+ACTIVE_DELIVERY_STAGES = ('DT1048_9:NEW', NAZNACHENIE_DRIVER_STAGE, 'DT1048_9:2', 'DT1048_9:3', SEND_DOCUMENTS_STAGE)
+CLOSED_DELIVERY_STAGES = ('DT1048_9:SUCCESS', 'DT1048_9:FAIL')
+# Доли закрытых стадий: неудачных доставок заметно меньше успешных
+CLOSED_STAGE_WEIGHTS = (9, 1)
+
+DOCUMENT_URL = 'https://bitrix.example/docs/{name}/{id}.pdf'
+ROUTE_LIST_URL = 'https://bitrix.example/disk/route/{id}'
+
+_FIRST_NAMES = ('Иван', 'Пётр', 'Сергей', 'Алексей', 'Дмитрий', 'Андрей', 'Михаил', 'Николай')
+_LAST_NAMES = ('Иванов', 'Петров', 'Сидоров', 'Смирнов', 'Кузнецов', 'Попов', 'Васильев', 'Соколов')
+_PRODUCTS = ('Цемент М500', 'Арматура А500С', 'Кирпич М150', 'Газобетон D500', 'Песок', 'Щебень', 'Профлист')
+_UNITS = ('шт', 'т', 'м³', 'м²')
+
+
+@dataclass
+class SyntheticConfig:
+    """
+    Масштаб и форма синтетических данных. Структура повторяет портал:
+    поставка -> отгрузки -> доставки (+ закупки), у доставки загрузка,
+    разгрузка, накладная, доверенность, маршрутный лист и товары.
+    """
+    supplies: int = 250
+    shipments_per_supply: int = 4
+    # Среднее число доставок на отгрузку; во вложенной структуре видна первая
+    deliveries_per_shipment: float = 1.0
+    max_purchases_per_shipment: int = 2
+    # Доля доставок в стадиях SUCCESS/FAIL
+    closed_share: float = 0.8
+    contacts: int = 200
+    # Доля доставок без водителя
+    unassigned_share: float = 0.1
+    max_product_rows: int = 3
+    seed: int = 42
+
+    @classmethod
+    def for_deliveries(cls, deliveries: int, **kwargs) -> 'SyntheticConfig':
+        """
+        Конфигурация примерно на deliveries доставок при остальных параметрах по умолчанию
+        (или из kwargs); число контактов растёт вместе с числом доставок.
+        """
+        config = cls(**kwargs)
+        per_supply = config.shipments_per_supply * config.deliveries_per_shipment
+        config.supplies = max(1, round(deliveries / per_supply))
+        if 'contacts' not in kwargs:
+            config.contacts = max(10, deliveries // 50)
+        return config
+
+
+def _iso(moment: datetime) -> str:
+    return moment.isoformat(timespec='seconds')
+
+
+def _phone(rnd: random.Random) -> str:
+    return '79' + ''.join(str(rnd.randrange(10)) for _ in range(9))
+
+
+def generate_cache(config: SyntheticConfig) -> Dict[str, Dict[int, Dict[str, Any]]]:
+    """
+    Детерминированно (по config.seed) собирает содержимое BitrixDeliveryManager.cache:
+    сущности в том виде, в каком их записывает загрузка из Bitrix.
+    """
+    rnd = random.Random(config.seed)
+    epoch = datetime(2024, 1, 1, tzinfo=timezone(timedelta(hours=3)))
+    span = 365 * 24 * 60 * 60
+    cache: Dict[str, Dict[int, Dict[str, Any]]] = {
+        name: {} for name in (
+            'delivery', 'shipment', 'purchase', 'unloading', 'loading', 'deal', 'supply',
+            'contact', 'nacladnaya', 'doverennost', 'marchrutniy_list', 'product_rows'
+        )
+    }
+    # Сделки и поставки - сделки CRM с общим счётчиком id, у смарт-процессов счётчик свой
+    next_id = {'deal': 1000, 'item': 1, 'contact': 100}
+
+    def new_id(counter: str) -> int:
+        next_id[counter] += 1
+        return next_id[counter]
+
+    def moments() -> Tuple[str, str]:
+        created = epoch + timedelta(seconds=rnd.randrange(span))
+        return _iso(created), _iso(created + timedelta(seconds=rnd.randrange(30 * 24 * 60 * 60)))
+
+    def item(name: str, parent_field: str, parent_id: int, stage: str, title: str) -> int:
+        item_id = new_id('item')
+        created, updated = moments()
+        cache[name][item_id] = {
+            'id': item_id, 'title': title, 'stageId': stage, 'categoryId': 9,
+            'createdTime': created, 'updatedTime': updated, 'assignedById': 1 + rnd.randrange(20),
+            parent_field: parent_id
+        }
+        return item_id
+
+    contact_ids = []
+    for _ in range(config.contacts):
+        contact_id = new_id('contact')
+        phones = [_phone(rnd) for _ in range(1 + (rnd.random() < 0.3))]
+        cache['contact'][contact_id] = {
+            'ID': str(contact_id), 'NAME': rnd.choice(_FIRST_NAMES), 'SECOND_NAME': '',
+            'LAST_NAME': rnd.choice(_LAST_NAMES), 'PHONE': phones[0], 'PHONES': phones,
+            'DATE_MODIFY': moments()[1]
+        }
+        contact_ids.append(contact_id)
+
+    for supply_no in range(config.supplies):
+        deal_id = new_id('deal')
+        supply_id = new_id('deal')
+        for deal_key, title, extra in (
+            (deal_id, f'Сделка {supply_no}', {}),
+            (supply_id, f'Поставка {supply_no}', {SUPPLY_DEAL_FIELD: str(deal_id)})
+        ):
+            created, updated = moments()
+            cache['supply' if extra else 'deal'][deal_key] = {
+                'ID': str(deal_key), 'TITLE': title, 'STAGE_ID': 'C1:EXECUTING', 'CATEGORY_ID': '1',
+                'DATE_CREATE': created, 'DATE_MODIFY': updated, 'ASSIGNED_BY_ID': '1',
+                'OPPORTUNITY': str(rnd.randrange(10000, 5000000)), 'CURRENCY_ID': 'RUB',
+                'COMPANY_ID': str(rnd.randrange(1, 500)), 'CONTACT_ID': None, **extra
+            }
+
+        for _ in range(config.shipments_per_supply):
+            shipment_id = item('shipment', 'parentId2', supply_id, 'DT1040_7:NEW', 'Отгрузка')
+            for _ in range(rnd.randint(0, config.max_purchases_per_shipment)):
+                item('purchase', 'parentId1040', shipment_id, 'DT1044_8:NEW', 'Закупка')
+
+            # Целая часть deliveries_per_shipment - всегда, дробная - с соответствующей вероятностью
+            count = int(config.deliveries_per_shipment)
+            count += rnd.random() < config.deliveries_per_shipment - count
+            for _ in range(count):
+                if rnd.random() < config.closed_share:
+                    stage = rnd.choices(CLOSED_DELIVERY_STAGES, weights=CLOSED_STAGE_WEIGHTS)[0]
+                else:
+                    stage = rnd.choice(ACTIVE_DELIVERY_STAGES)
+                delivery_id = item('delivery', 'parentId1040', shipment_id, stage, 'Доставка')
+                delivery = cache['delivery'][delivery_id]
+                assigned = contact_ids and rnd.random() >= config.unassigned_share
+                delivery[DRIVER_FIELD] = rnd.choice(contact_ids) if assigned else None
+                route_url = ROUTE_LIST_URL.format(id=delivery_id)
+                delivery[ROUTE_LIST_FIELD] = {'url': route_url}
+                cache['marchrutniy_list'][delivery_id] = {'downloadUrl': route_url}
+
+                for name, type_id in (('loading', 1060), ('unloading', 1056), ('nacladnaya', 1064), ('doverennost', 1068)):
+                    item(name, 'parentId1048', delivery_id, f'DT{type_id}_10:NEW', name.title())
+
+                rows = [
+                    {
+                        'product_name': rnd.choice(_PRODUCTS),
+                        'quantity': rnd.randint(1, 100),
+                        'unit': rnd.choice(_UNITS)
+                    }
+                    for _ in range(rnd.randint(0, config.max_product_rows))
+                ]
+                if rows:
+                    cache['product_rows'][delivery_id] = rows
+
+    return cache
+
+
+def document_urls(cache: Dict[str, Dict[int, Dict[str, Any]]]) -> Dict[Tuple[str, int], str]:
+    """
+    Ссылки на PDF документов в формате BitrixDeliveryManager.document_urls.
+    """
+    return {
+        (name, document_id): DOCUMENT_URL.format(name=name, id=document_id)
+        for name in ('nacladnaya', 'doverennost')
+        for document_id in cache[name]
+    }
@@ -1,12 +1,23 @@
+import asyncio
+from contextlib import asynccontextmanager
 from datetime import datetime, timezone, date
-from fastapi import FastAPI
+from fastapi import FastAPI, Query, Request, Response
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from itertools import islice
 import json
 import os
+import threading
+import time
 from pydantic import BaseModel
 
-from webservice.src.driver_index_builder import get_drivers_deliveries
+from webservice.src.driver_index_builder import get_drivers_deliveries, iter_drivers_deliveries
 from webservice.src.bitrix_delivery_manager import BitrixDeliveryManager
-from webservice.src.driver_index_builder import DriverIndexBuilder
+from webservice.src.jobs import Job, JobRunner
+from webservice.src.metrics import HTTP_REQUEST_SECONDS, REGISTRY
+from webservice.src.outbox import NotificationOutbox
+from webservice.src.response_cache import ResponseCache, dumps_response
+from webservice.src.sync_scheduler import SyncScheduler
+from webservice.src import tracing
 
 
 def encrypt_response(data: dict) -> dict:
@@ -16,69 +27,354 @@ def encrypt_response(data: dict) -> dict:
     return {"data": encrypted.decode("utf-8")}
 
 # --- Хранилище ---
+# Один путь кэша для старта и плановых перезагрузок: иначе кэш и водяные знаки разъезжаются по файлам
+CACHE_FILE = os.environ.get("BITRIX_CACHE_FILE", "bitrix_cache.json")
+# Очередь уведомлений n8n общая для всех пересозданий менеджера
+outbox = NotificationOutbox.from_env(CACHE_FILE)
+# BITRIX_FORCE_RELOAD=0 - старт из сохранённого кэша (снимок/SQLite декодируется лениво)
 manager: BitrixDeliveryManager = BitrixDeliveryManager(
     os.environ.get("BITRIX_WEBHOOK_URL"),
-    os.environ.get("BITRIX_CACHE_FILE", "bitrix_cache.json"),
-    force_reload=True
+    CACHE_FILE,
+    force_reload=os.environ.get("BITRIX_FORCE_RELOAD", "1") == "1",
+    outbox=outbox
 )
-driver_index: DriverIndexBuilder = DriverIndexBuilder(manager)
 last_update_time = datetime.now(timezone.utc)
+# Долгие загрузки/обновления идут фоновыми задачами, роуты чтения отвечают из памяти
+jobs = JobRunner()
+# Полная загрузка и дельта-обновление не выполняются одновременно
+sync_lock = threading.Lock()
+# Сериализованные ответы тяжёлых эндпоинтов по версии данных менеджера
+response_cache = ResponseCache()
+
+
+# Метрики, которые читаются из текущего менеджера при каждой выдаче /metrics
+REGISTRY.gauge(
+    'bitrix_cache_entities', 'Записей в кэше по типам сущностей', ['entity'],
+    collect=lambda: {(name,): size for name, size in manager.cache_sizes().items()}
+)
+REGISTRY.gauge(
+    'bitrix_document_urls_cached', 'Ссылок на PDF документов в кэше',
+    collect=lambda: {(): len(manager.document_urls)}
+)
+
+
+# --- Фоновые задачи ---
+def run_load(job: Job):
+    global manager, last_update_time
+    with sync_lock:
+        started = datetime.now(timezone.utc)
+        previous = manager
+        new_manager = BitrixDeliveryManager(
+            os.environ.get("BITRIX_WEBHOOK_URL"),
+            CACHE_FILE,
+            force_reload=True,
+            progress_callback=job.report,
+            outbox=outbox
+        )
+        # Полная загрузка не сравнивает снимки: переходы с последней дельты
+        # и за время загрузки находятся сравнением со старым кэшем
+        new_manager.notify_changes_since(previous)
+        # Читатели продолжают работать со старым менеджером, пока новый не собран
+        manager = new_manager
+        last_update_time = started
+        # Запросы, начатые до подмены, ещё могут дойти до старого клиента: сессия переоткроет соединения
+        previous.close()
+        # Ссылки на документы активных доставок - уже после подмены, вне критического пути загрузки
+        try:
+            new_manager.prefetch_document_urls()
+        finally:
+            new_manager.progress_callback = None
+
+
+def run_refresh(job: Job):
+    global last_update_time
+    with sync_lock:
+        started = datetime.now(timezone.utc)
+        manager.progress_callback = job.report
+        try:
+            manager.refresh_updates()
+        finally:
+            manager.progress_callback = None
+        last_update_time = started
+
+
+# Плановая синхронизация: BITRIX_SYNC_INTERVAL - дельта (сек), BITRIX_FULL_RELOAD_INTERVAL - полная сверка, 0 отключает
+scheduler = SyncScheduler(
+    jobs,
+    delta=run_refresh,
+    full=run_load,
+    delta_interval=float(os.environ.get("BITRIX_SYNC_INTERVAL", 60)),
+    full_interval=float(os.environ.get("BITRIX_FULL_RELOAD_INTERVAL", 6 * 60 * 60))
+)
 
 
 # --- FastAPI ---
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    outbox.start()
+    scheduler.start()
+    yield
+    scheduler.stop()
+    outbox.stop()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.middleware("http")
+async def observe_request_latency(request: Request, call_next):
+    started = time.perf_counter()
+    status = 500
+    with tracing.trace("request", f"{request.method} {request.url.path}") as span:
+        try:
+            response = await call_next(request)
+            status = response.status_code
+            return response
+        finally:
+            # Шаблон пути роута ("/delivery_info/{delivery_id}"), а не сам путь, чтобы не плодить метки
+            route = getattr(request.scope.get("route"), "path", "unmatched")
+            HTTP_REQUEST_SECONDS.labels(route, request.method, status).observe(time.perf_counter() - started)
+            if span is not None:
+                span.set(route=route, status=status)
 
 
 # --- Роуты ---
-@app.post("/load")
-async def api_load():
-    global manager, driver_index, last_update_time
-    manager.refresh_updates(last_update_time)
-    manager = BitrixDeliveryManager(
-        os.environ.get("BITRIX_WEBHOOK_URL"),
-        os.environ.get("BITRIX_CACHE_FILE", "webservice/src/bitrix_cache.json"),
-        force_reload=True
+def _etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    return header.strip() == "*" or etag in (tag.strip().removeprefix("W/") for tag in header.split(","))
+
+
+async def cached_response(request: Request, endpoint: str, params: dict, build) -> Response:
+    """
+    Ответ из response_cache с ETag: при совпавшем If-None-Match - 304 без тела,
+    иначе тело собирается (в потоке) только если данные изменились с прошлой сборки.
+    """
+    current = manager
+    version = current.data_tag
+    etag = ResponseCache.etag(endpoint, params, version)
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    etag, body = await asyncio.to_thread(
+        response_cache.get_or_build, endpoint, params, version, lambda: encrypt_response(build(current))
     )
-    driver_index = DriverIndexBuilder(manager)
-    last_update_time = datetime.now(timezone.utc)
-    
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
+
+
+def paginate(items, limit: int) -> dict:
+    """
+    Страница из итератора пар (id, значение) по возрастанию id.
+    next_cursor - id последнего элемента страницы, если дальше есть ещё.
+    """
+    page = list(islice(items, limit + 1))
+    return {
+        "items": dict(page[:limit]),
+        "next_cursor": page[limit - 1][0] if len(page) > limit else None
+    }
+
+
+def ndjson(items, id_key: str, value_key: str):
+    # По строке на элемент: в памяти одновременно только один сериализованный элемент
+    for item_id, value in items:
+        yield dumps_response(encrypt_response({id_key: item_id, value_key: value})) + b"\n"
+
+
+@app.get("/metrics")
+async def api_metrics():
+    return Response(content=REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+# --- Отладка: трассы и профилировщик ---
+@app.get("/debug/tracing")
+async def api_tracing_status(kind: str | None = None):
+    return encrypt_response({"enabled": tracing.is_enabled(), "traces": tracing.list_traces(kind)})
+
+
+@app.post("/debug/tracing")
+async def api_tracing_toggle(enabled: bool):
+    tracing.set_enabled(enabled)
+    return encrypt_response({"enabled": tracing.is_enabled()})
+
+
+@app.get("/debug/traces/{trace_id}")
+async def api_trace(trace_id: str):
+    record = tracing.get_trace(trace_id)
+    if record is None:
+        return encrypt_response({"error": "Трасса не найдена"})
+    return encrypt_response(record.to_dict())
+
+
+@app.post("/debug/profile")
+async def api_profile(kind: str = Query("refresh", pattern="^(load|refresh|request)$")):
+    """
+    Снять сэмплирующим профилировщиком следующий запуск вида kind;
+    профиль - GET /debug/traces/{trace_id}/flamegraph.
+    """
+    tracing.arm_profile(kind)
+    return encrypt_response({"armed": kind})
+
 
-    return encrypt_response({"status": "loaded"})
+@app.get("/debug/traces/{trace_id}/flamegraph")
+async def api_trace_flamegraph(trace_id: str):
+    record = tracing.get_trace(trace_id)
+    if record is None or record.profile is None:
+        return encrypt_response({"error": "Профиль трассы не найден"})
+    return PlainTextResponse(record.folded_stacks())
+
+
+@app.post("/load")
+async def api_load():
+    job = jobs.start("load", run_load)
+    return encrypt_response({"status": job.status, "job": job.to_dict()})
 
 
 @app.get("/refresh")
 async def api_refresh():
-    global manager, driver_index, last_update_time
     if manager is None:
         return encrypt_response({"error": "BitrixDeliveryManager is not loaded"})
-    manager.refresh_updates(last_update_time)
-    driver_index = DriverIndexBuilder(manager)
-    last_update_time = datetime.now(timezone.utc)
+    job = jobs.start("refresh", run_refresh)
+    return encrypt_response({"status": job.status, "job": job.to_dict()})
+
+
+@app.get("/sync_status")
+async def api_sync_status():
+    return encrypt_response({
+        **scheduler.status(),
+        "last_update_time": last_update_time.isoformat(),
+        "outbox": outbox.stats()
+    })
+
 
-    return encrypt_response({"status": "refreshed"})
+@app.get("/outbox/failed")
+async def api_outbox_failed(limit: int = Query(100, ge=1, le=1000)):
+    return encrypt_response({"failed": outbox.failed(limit)})
+
+
+@app.post("/outbox/requeue")
+async def api_outbox_requeue(key: list[str] | None = Query(None)):
+    """
+    Вернуть в очередь неотправленные уведомления: все failed или только key (можно повторять).
+    """
+    return encrypt_response({"requeued": outbox.requeue_failed(key)})
+
+
+@app.get("/jobs")
+async def api_jobs():
+    return encrypt_response({"jobs": [job.to_dict() for job in jobs.list()]})
+
+
+@app.get("/jobs/{job_id}")
+async def api_job_status(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        return encrypt_response({"error": "Задача не найдена"})
+    return encrypt_response(job.to_dict())
 
 
 @app.get("/get")
-async def api_get():
-    return encrypt_response({
-        "cache": manager.cache,
-        "structure": manager.build_nested_structure(),
+async def api_get(request: Request):
+    return await cached_response(request, "get", {}, lambda current: {
+        "cache": current.snapshot_cache(),
+        "structure": current.build_nested_structure(),
     })
 
 
 @app.get("/drivers_deliveries")
-async def api_drivers_deliveries():
-    global driver_index
-    return encrypt_response(
-        get_drivers_deliveries(
-            bitrix_delivery_manager=manager,
-            driver_index_builder=driver_index
-        )
+async def api_drivers_deliveries(request: Request):
+    return await cached_response(
+        request, "drivers_deliveries", {}, lambda current: get_drivers_deliveries(bitrix_delivery_manager=current)
     )
 
 
+@app.get("/get/supplies")
+async def api_get_supplies(
+    request: Request,
+    cursor: int | None = None,
+    limit: int = Query(100, ge=1, le=1000),
+    supply_from: int | None = None,
+    supply_to: int | None = None,
+    stage: str | None = None,
+    modified_since: datetime | None = None
+):
+    """
+    Постраничная структура поставок: cursor - next_cursor прошлой страницы.
+    """
+    filters = dict(supply_from=supply_from, supply_to=supply_to, stage=stage, modified_since=modified_since)
+    return await cached_response(
+        request, "get/supplies", {"cursor": cursor, "limit": limit, **filters},
+        lambda current: paginate(current.iter_nested_structure(after=cursor, **filters), limit)
+    )
+
+
+@app.get("/get/stream")
+async def api_get_stream(
+    supply_from: int | None = None,
+    supply_to: int | None = None,
+    stage: str | None = None,
+    modified_since: datetime | None = None
+):
+    """
+    Структура поставок в NDJSON: строка на поддерево поставки.
+    """
+    items = manager.iter_nested_structure(
+        supply_from=supply_from, supply_to=supply_to, stage=stage, modified_since=modified_since
+    )
+    return StreamingResponse(ndjson(items, "supply_id", "structure"), media_type="application/x-ndjson")
+
+
+@app.get("/drivers_deliveries/page")
+async def api_drivers_deliveries_page(
+    request: Request,
+    cursor: int | None = None,
+    limit: int = Query(100, ge=1, le=1000),
+    stage: str | None = None,
+    modified_since: datetime | None = None
+):
+    return await cached_response(
+        request, "drivers_deliveries/page",
+        {"cursor": cursor, "limit": limit, "stage": stage, "modified_since": modified_since},
+        lambda current: paginate(iter_drivers_deliveries(
+            current, after=cursor, stage=stage, modified_since=modified_since
+        ), limit)
+    )
+
+
+@app.get("/drivers_deliveries/stream")
+async def api_drivers_deliveries_stream(stage: str | None = None, modified_since: datetime | None = None):
+    items = iter_drivers_deliveries(manager, stage=stage, modified_since=modified_since)
+    return StreamingResponse(ndjson(items, "driver_id", "deliveries"), media_type="application/x-ndjson")
+
+
+@app.get("/deliveries")
+async def api_deliveries(
+    request: Request,
+    stage: list[str] | None = Query(None),
+    driver_id: int | None = None,
+    active: bool | None = None,
+    date_from: datetime | None = None,
+    date_to: datetime | None = None,
+    date_field: str = Query("createdTime", pattern="^(createdTime|updatedTime)$")
+):
+    """
+    Доставки по набору стадий (stage можно повторять), водителю, активности и окну дат.
+    """
+    filters = dict(
+        stages=sorted(stage) if stage else None, driver_id=driver_id, active=active,
+        date_from=date_from, date_to=date_to, date_field=date_field
+    )
+
+    def build(current):
+        deliveries = current.query_deliveries(**filters)
+        return {"deliveries": deliveries, "count": len(deliveries)}
+
+    return await cached_response(request, "deliveries", filters, build)
+
+
+# Роуты ниже обычные (def): FastAPI выполняет их в пуле потоков, и ожидание
+# блокировки менеджера во время фонового обновления не останавливает event loop
 @app.get("/delivery_info/{delivery_id}")
-async def api_delivery_info(delivery_id: int):
+def api_delivery_info(delivery_id: int):
     try:
         info = manager.get_delivery_full_info_by_id(delivery_id)
         return encrypt_response(info)
@@ -87,16 +383,15 @@ async def api_delivery_info(delivery_id: int):
 
 
 @app.get("/delivery_driver/{delivery_id}")
-async def api_delivery_driver(delivery_id: int):
+def api_delivery_driver(delivery_id: int):
     try:
-        info = manager.get_delivery_full_info_by_id(delivery_id)
-        return encrypt_response({"driver": info.get("driver")})
+        return encrypt_response({"driver": manager.get_delivery_driver(delivery_id)})
     except ValueError as e:
         return encrypt_response({"error": str(e)})
 
 
 @app.get("/driver_deliveries/{driver_id}")
-async def api_driver_deliveries(driver_id: int):
+def api_driver_deliveries(driver_id: int):
     try:
         deliveries = manager.get_deliveries_grouped_by_driver(
             search_driver_id=driver_id, is_active_deliveries=False
@@ -107,7 +402,7 @@ async def api_driver_deliveries(driver_id: int):
 
 
 @app.post("/driver_id_by_phone/{phone_number}")
-async def api_driver_id_by_phone(phone_number: str):
+def api_driver_id_by_phone(phone_number: str):
     try:
         driver_id = manager.get_driver_id_by_phone(phone_number)
         if driver_id is None:
@@ -126,7 +421,7 @@ class MoveStageRequest(BaseModel):
 @app.post("/move_stage")
 async def api_move_stage(data: MoveStageRequest):
     try:
-        success = manager.move_entity_to_stage(
+        success = await manager.amove_entity_to_stage(
             entity_name=data.entity_name,
             entity_id=data.entity_id,
             new_stage_id=data.new_stage_id
@@ -33,7 +33,7 @@ def run_get():
         "cache": manager.cache,
         "nested": manager.build_nested_structure()
     }
-    print(json.dumps(data, ensure_ascii=False, indent=2))
+    print(json.dumps(data, ensure_ascii=False, indent=2, default=dict))
 
 
 if __name__ == "__main__":
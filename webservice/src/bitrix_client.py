@@ -0,0 +1,177 @@
+import logging
+import random
+import threading
+import time
+from typing import Any, Dict
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from webservice.src import tracing
+from webservice.src.metrics import BITRIX_RATE_LIMIT_WAIT_SECONDS, BITRIX_REQUEST_SECONDS, BITRIX_REQUESTS
+
+
+# Ошибки Bitrix, после которых запрос имеет смысл повторить
+RETRYABLE_ERRORS = {'QUERY_LIMIT_EXCEEDED', 'INTERNAL_SERVER_ERROR', 'OPERATION_TIME_LIMIT'}
+
+
+class BitrixAPIError(Exception):
+    def __init__(self, method: str, error: Any, description: str = ""):
+        self.method = method
+        self.error = error
+        self.description = description
+        super().__init__(f"{method}: {error} {description}".strip())
+
+
+def method_name(method: str) -> str:
+    """
+    Имя метода без слэшей и суффикса .json - метка метрик ('crm.item.list').
+    """
+    return method.strip('/').removesuffix('.json')
+
+
+def is_retryable_error(error: Any) -> bool:
+    """
+    Проверяет ошибку Bitrix (строку или словарь из result_error) на временную.
+    """
+    if isinstance(error, dict):
+        error = error.get('error')
+    return error in RETRYABLE_ERRORS
+
+
+class TokenBucket:
+    """
+    Потокобезопасный token bucket: rate токенов в секунду, не больше capacity подряд.
+    """
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def try_acquire(self) -> bool:
+        """
+        Берёт токен без ожидания; False, если квота сейчас исчерпана.
+        """
+        with self._lock:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+
+class BitrixClient:
+    """
+    HTTP-клиент Bitrix REST: пул keep-alive соединений, ограничение частоты
+    запросов под квоту Bitrix (2 запроса/с, всплеск до 50) и повторы с
+    экспоненциальной задержкой при QUERY_LIMIT_EXCEEDED и ответах 429/5xx.
+    """
+    def __init__(
+        self,
+        webhook_url: str,
+        rate: float = 2.0,
+        burst: int = 50,
+        max_retries: int = 5,
+        backoff_base: float = 1.0,
+        backoff_max: float = 30.0,
+        timeout: float = 60.0,
+        pool_size: int = 10
+    ):
+        self.webhook_url = webhook_url.rstrip("/")
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.limiter = TokenBucket(rate, burst)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def close(self):
+        self.session.close()
+
+    def backoff(self, attempt: int):
+        delay = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        time.sleep(delay * (0.5 + random.random() / 2))
+
+    def call(self, method: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Вызывает метод REST и возвращает разобранный JSON-ответ.
+        Ответы с неповторяемой ошибкой Bitrix возвращаются как есть; ответы 4xx
+        без ошибки Bitrix и ответы не в JSON (страница прокси, авторизации)
+        возвращаются как {'error': 'HTTP <код>'} или {'error': 'INVALID_RESPONSE'},
+        а не как пустой результат. При исчерпании повторов выбрасывается BitrixAPIError.
+        """
+        url = f"{self.webhook_url}/{method.lstrip('/')}"
+        name = method_name(method)
+        last_error: Any = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                logging.warning(f"Повтор {method} ({attempt}/{self.max_retries}) после ошибки: {last_error}")
+                self.backoff(attempt - 1)
+            waited = time.perf_counter()
+            self.limiter.acquire()
+            started = time.perf_counter()
+            BITRIX_RATE_LIMIT_WAIT_SECONDS.inc(started - waited)
+            try:
+                with tracing.span('bitrix', method=name, attempt=attempt):
+                    response = self.session.post(url, json=params, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                BITRIX_REQUESTS.labels(name, 'connection_error').inc()
+                last_error = e
+                continue
+            finally:
+                BITRIX_REQUEST_SECONDS.labels(name).observe(time.perf_counter() - started)
+
+            try:
+                res = response.json()
+            except ValueError:
+                res = None
+            if not isinstance(res, dict):
+                res = None
+
+            error = res.get('error') if res is not None else None
+            if is_retryable_error(error):
+                BITRIX_REQUESTS.labels(name, 'throttled' if error == 'QUERY_LIMIT_EXCEEDED' else 'retryable_error').inc()
+                last_error = error
+                continue
+            if response.status_code == 429:
+                BITRIX_REQUESTS.labels(name, 'throttled').inc()
+                last_error = "HTTP 429"
+                continue
+            if response.status_code >= 500:
+                BITRIX_REQUESTS.labels(name, 'http_5xx').inc()
+                last_error = f"HTTP {response.status_code}"
+                continue
+            if error is not None:
+                BITRIX_REQUESTS.labels(name, 'error').inc()
+                return res
+            if response.status_code >= 400:
+                BITRIX_REQUESTS.labels(name, 'http_4xx').inc()
+                return {'error': f"HTTP {response.status_code}", 'error_description': response.text[:200]}
+            if res is None:
+                BITRIX_REQUESTS.labels(name, 'invalid_response').inc()
+                return {'error': 'INVALID_RESPONSE', 'error_description': response.text[:200]}
+            BITRIX_REQUESTS.labels(name, 'ok').inc()
+            return res
+
+        BITRIX_REQUESTS.labels(name, 'retries_exhausted').inc()
+        raise BitrixAPIError(method, last_error, "повторы исчерпаны")
@@ -1,20 +1,231 @@
-import requests
+import asyncio
+import functools
 import logging
-from datetime import datetime
-from typing import Dict, Any, List
-import json
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, Any, Iterator, List, Tuple
+from urllib.parse import urlencode
 import os
+import threading
+import uuid
 
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from webservice.src.cache_store import LazyCache, make_cache_store
+from webservice.src.change_detector import detect_changes
+from webservice.src.entity_schema import compact, compact_items, select_fields
+from webservice.src.bitrix_client import BitrixAPIError, BitrixClient, is_retryable_error, method_name
+from webservice.src.load_graph import Stage, run_stage_graph
+from webservice.src.metrics import BITRIX_BATCH_COMMANDS, BITRIX_COMMAND_ERRORS, BITRIX_PAGES, track_stage, track_sync
+from webservice.src import tracing
+from webservice.src.outbox import NotificationOutbox
+from webservice.src.ttl_cache import TTLCache
 
 logging.basicConfig(level=logging.INFO)
 
+# Максимум команд в одном запросе batch (ограничение Bitrix REST)
+BATCH_LIMIT = 50
+# Размер страницы списочных методов Bitrix при start=-1
+KEYSET_PAGE_SIZE = 50
+# Глубина дельты, если водяного знака ещё нет (кэш прежнего формата)
+DEFAULT_LOOKBACK = timedelta(days=1)
+# Типы-документы, для которых Bitrix генерирует PDF
+DOCUMENT_TYPES = ('nacladnaya', 'doverennost')
+# Поля доставки, по которым query_deliveries фильтрует окно дат (есть в компактных записях)
+DELIVERY_DATE_FIELDS = ('createdTime', 'updatedTime')
+
+
+class RefreshError(Exception):
+    """
+    Дельта-синхронизация прошла не полностью: stages - стадии, завершившиеся ошибкой.
+    Успешные стадии при этом применены и сохранены.
+    """
+    def __init__(self, stages: List[str]):
+        self.stages = stages
+        super().__init__(f"Обновление завершилось с ошибками на стадиях: {', '.join(stages)}")
+
+
+def _is_active_stage(stage: str | None) -> bool:
+    stage = stage or ''
+    return 'SUCCESS' not in stage and 'FAIL' not in stage
+
+
+def _is_active(delivery: Dict[str, Any]) -> bool:
+    return _is_active_stage(delivery.get('stageId'))
+
+
+def _parse_time(value: Any) -> datetime | None:
+    """
+    Время из ISO-строки Bitrix; время без часового пояса считается UTC.
+    """
+    if isinstance(value, datetime):
+        moment = value
+    else:
+        try:
+            moment = datetime.fromisoformat(value)
+        except (TypeError, ValueError):
+            return None
+    return moment if moment.tzinfo else moment.replace(tzinfo=timezone.utc)
+
+
+def _modified_at(item: Dict[str, Any] | None) -> datetime | None:
+    """
+    Время изменения: DATE_MODIFY у сделок и контактов, updatedTime у элементов.
+    """
+    return _parse_time((item or {}).get('DATE_MODIFY') or (item or {}).get('updatedTime'))
+
+
+def delivery_block_matches(block: Dict[str, Any] | None, stage: str = None, modified_since: datetime = None) -> bool:
+    """
+    Подходит ли блок доставки под фильтры: стадия доставки и изменение
+    доставки или её загрузки/разгрузки/документов не раньше modified_since.
+    """
+    if not block or not block.get('delivery'):
+        return False
+    if stage is not None and block['delivery'].get('stageId') != stage:
+        return False
+    if modified_since is not None:
+        if modified_since.tzinfo is None:
+            modified_since = modified_since.replace(tzinfo=timezone.utc)
+        moments = [
+            _modified_at(block.get(name))
+            for name in ('delivery', 'loading', 'unloading', 'nacladnaya', 'doverennost')
+        ]
+        if not any(moment is not None and moment >= modified_since for moment in moments):
+            return False
+    return True
+
+
+def supply_subtree_matches(subtree: Dict[str, Any], stage: str = None, modified_since: datetime = None) -> bool:
+    """
+    Подходит ли поддерево поставки под фильтры. stage - стадия поставки (STAGE_ID)
+    или любой её доставки; modified_since - изменение поставки, сделки,
+    отгрузки, закупки или любого блока доставки.
+    """
+    if stage is not None and subtree['supply'].get('STAGE_ID') != stage and not any(
+        delivery_block_matches(entry['delivery_block'], stage=stage) for entry in subtree['shipments']
+    ):
+        return False
+    if modified_since is not None:
+        if modified_since.tzinfo is None:
+            modified_since = modified_since.replace(tzinfo=timezone.utc)
+        items = [subtree['supply'], subtree['deal']]
+        for entry in subtree['shipments']:
+            items.append(entry['shipment'])
+            items.extend(entry['purchases'])
+        modified = any(
+            moment is not None and moment >= modified_since for moment in map(_modified_at, items)
+        ) or any(
+            delivery_block_matches(entry['delivery_block'], modified_since=modified_since)
+            for entry in subtree['shipments']
+        )
+        if not modified:
+            return False
+    return True
+
+
+def _flatten_params(params: Any, prefix: str = "") -> List[Tuple[str, str]]:
+    """
+    Разворачивает вложенные параметры в пары для query string в формате PHP
+    (filter[parentId2][0]=1), как этого ждут команды внутри batch.
+    """
+    if isinstance(params, dict):
+        pairs = []
+        for key, value in params.items():
+            pairs.extend(_flatten_params(value, f"{prefix}[{key}]" if prefix else str(key)))
+        return pairs
+    if isinstance(params, (list, tuple)):
+        pairs = []
+        for idx, value in enumerate(params):
+            pairs.extend(_flatten_params(value, f"{prefix}[{idx}]"))
+        return pairs
+    if params is None:
+        return [(prefix, "")]
+    return [(prefix, str(params))]
+
+
+def normalize_phone(phone: str) -> str:
+    """
+    Приводит номер к ключу индекса: только цифры, российские 8XXXXXXXXXX
+    и XXXXXXXXXX (без кода страны) сводятся к 7XXXXXXXXXX.
+    """
+    digits = ''.join(filter(str.isdigit, phone or ''))
+    if len(digits) == 11 and digits[0] == '8':
+        return '7' + digits[1:]
+    if len(digits) == 10:
+        return '7' + digits
+    return digits
+
+
+def _locked(method):
+    """
+    Выполняет метод под self._lock: чтения не пересекаются с записью
+    кэша из фоновых задач обновления.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+@contextmanager
+def _sync_stage(operation: str, stage: str, parent: tracing.Span | None = None):
+    # Стадия синхронизации: спан трассы и метрики длительности
+    with tracing.span(stage, parent=parent, operation=operation), track_stage(operation, stage):
+        yield
+
+
+def _count_error(method: str, error: Any):
+    # error - строка или словарь из result_error batch
+    code = error.get('error') if isinstance(error, dict) else error
+    BITRIX_COMMAND_ERRORS.labels(method_name(method), str(code)).inc()
+
+
+def _extract_items(result: Any) -> List[Dict[str, Any]]:
+    if isinstance(result, dict):
+        for key in ('items', 'documents', 'productRows'):
+            if key in result:
+                return result[key]
+    return result or []
+
 
 class BitrixDeliveryManager:
-    def __init__(self, webhook_url: str, cache_file: str, force_reload: bool = True):
+    def __init__(
+        self,
+        webhook_url: str,
+        cache_file: str,
+        force_reload: bool = True,
+        load_concurrency: int = None,
+        cache_backend: str = None,
+        progress_callback: Callable[..., None] = None,
+        outbox: NotificationOutbox = None,
+        raw: bool = None
+    ):
         self.webhook_url = webhook_url.rstrip("/")
+        # progress_callback(stage, **info) - прогресс долгих операций (загрузка, обновление)
+        self.progress_callback = progress_callback
+        # Сколько независимых стадий load_supplies выполняется одновременно;
+        # общий token bucket клиента всё равно держит суммарную частоту в квоте
+        self.load_concurrency = load_concurrency or int(os.environ.get("BITRIX_LOAD_CONCURRENCY", 4))
+        # Квота запросов: BITRIX_RATE_LIMIT в секунду, всплеск до BITRIX_RATE_BURST
+        self.client = BitrixClient(
+            self.webhook_url,
+            rate=float(os.environ.get("BITRIX_RATE_LIMIT", 2)),
+            burst=int(os.environ.get("BITRIX_RATE_BURST", 50)),
+            pool_size=max(10, self.load_concurrency)
+        )
+        # Сырой режим (BITRIX_RAW_ENTITIES=1): все поля Bitrix в словарях, без проекции по ENTITY_FIELDS
+        self.raw = raw if raw is not None else os.environ.get("BITRIX_RAW_ENTITIES", "0") == "1"
+        self._lock = threading.RLock()
         self.cache_file = cache_file
-        self.was_sent = []
+        self.store = make_cache_store(cache_file, cache_backend)
+        # id, изменённые с последнего сохранения, и флаг полной перезаписи после load_supplies
+        self._changed: Dict[str, set] = defaultdict(set)
+        self._full_save_needed = False
+        # Очередь уведомлений n8n; воркер отправки запускает приложение (outbox.start)
+        self.outbox = outbox or NotificationOutbox.from_env(cache_file)
         self.cache: Dict[str, Dict[int, Dict[str, Any]]] = {
             'delivery': {},
             'shipment': {},
@@ -26,7 +237,9 @@ class BitrixDeliveryManager:
             'contact': {}, 
             'nacladnaya': {},
             'doverennost': {},
-            'marchrutniy_list': {}
+            'marchrutniy_list': {},
+            # delivery_id -> товарные позиции доставки (только непустые)
+            'product_rows': {}
         }
         self.entity_type_ids = {
             'shipment': 1040,
@@ -46,57 +259,521 @@ class BitrixDeliveryManager:
             'nacladnaya': 'parentId1048',
             'doverennost': 'parentId1048'
         }
+        # Индексы parent_id -> {child_id} по каждому типу из entity_type2parent_id
+        self.children_index: Dict[str, Dict[int, set]] = {}
+        # Обратный индекс child_id -> parent_id (нужен при смене родителя)
+        self._parent_of: Dict[str, Dict[int, int]] = {}
+        self.entity_type2parent_type = {
+            'shipment': 'supply',
+            'delivery': 'shipment',
+            'purchase': 'shipment',
+            'loading': 'delivery',
+            'unloading': 'delivery',
+            'nacladnaya': 'delivery',
+            'doverennost': 'delivery'
+        }
+        # Нормализованный телефон -> id контакта (все номера контакта)
+        self.phone_index: Dict[str, int] = {}
+        # id водителя -> {id доставки}, stageId -> {id доставки} и обратные индексы;
+        # строятся вместе с индексом доставок
+        self.driver_deliveries: Dict[int, set] = {}
+        self._driver_of: Dict[int, int] = {}
+        self.stage_deliveries: Dict[str, set] = {}
+        self._stage_of: Dict[int, str] = {}
+        # id сделки -> {id поставки}, которые на неё ссылаются (UF_CRM_1728985624)
+        self.deal_supplies: Dict[int, set] = {}
+        self._deal_of: Dict[int, int] = {}
+        # Типы, для которых индексы уже построены
+        self._indexed: set = set()
+        # Материализованная вложенная структура и поставки, чьи поддеревья устарели
+        self._nested: Dict[int, Dict[str, Any]] = {}
+        self._nested_valid = False
+        self._dirty_supplies: set = set()
+        # Версия данных: растёт при каждом изменении кэша или ссылок на документы.
+        # Эпоха отличает версии разных экземпляров менеджера (после /load счёт начинается заново)
+        self.data_version = 0
+        self.data_epoch = uuid.uuid4().hex[:12]
+        # Водяные знаки дельта-синхронизации: вид выгрузки ('deal', 'contact', тип элемента)
+        # -> ISO-время начала последней успешной выгрузки. Сохраняются вместе с кэшем
+        self.watermarks: Dict[str, str] = {}
+        self.deletions_checked_at: str | None = None
+        # Перекрытие окна дельты на расхождение часов и запаздывающие записи Bitrix
+        self.watermark_overlap = timedelta(seconds=float(os.environ.get("BITRIX_WATERMARK_OVERLAP", 120)))
+        # Как часто сверять удаления по спискам id, сек
+        self.deletion_check_interval = float(os.environ.get("BITRIX_DELETION_CHECK_INTERVAL", 15 * 60))
+        # Ссылки на PDF документов: (тип, id документа) -> pdfUrl или None, если PDF нет.
+        # Разрешаются по требованию, заранее - только для активных доставок
+        self.document_urls = TTLCache(
+            maxsize=int(os.environ.get("BITRIX_DOCUMENT_URL_CACHE_SIZE", 10000)),
+            ttl=float(os.environ.get("BITRIX_DOCUMENT_URL_TTL", 60 * 60))
+        )
 
-        if os.path.exists(self.cache_file) and not force_reload:
-            self._load_cache_from_file()
+        if self.store.exists() and not force_reload and self._load_cache_from_file():
+            self._rebuild_indexes()
+            self._invalidate_nested()
+            self._load_meta()
             print("Кэш загружен из файла.")
         else:
             self.load_supplies()
             self._save_cache_to_file()
             print("Кэш собран и сохранён.")
 
-    def _paginate_list(self, method: str, params: Dict[str, Any], limit: int = 50) -> List[Dict[str, Any]]:
-        all_items = []
-        start = 0
-        while True:
+    @property
+    def data_tag(self) -> str:
+        """
+        Метка текущего состояния данных для кэширования ответов и ETag.
+        Истёкшие ссылки на документы тоже меняют метку: они скопированы
+        во вложенную структуру и должны из неё уйти.
+        """
+        self.document_urls.expire()
+        return f"{self.data_epoch}.{self.data_version}.{self.document_urls.generation}"
+
+    def _report_progress(self, stage: str, **info):
+        if self.progress_callback is not None:
+            self.progress_callback(stage, **info)
+
+    @staticmethod
+    def _tracked(operation: str, stage: str, func: Callable[[], Any]) -> Callable[[], Any]:
+        # Стадия графа загрузки выполняется в потоке пула: родительский спан передаётся явно
+        parent = tracing.current_span()
+
+        def run():
+            with _sync_stage(operation, stage, parent=parent):
+                return func()
+        return run
+
+    def _parent_id(self, name: str, item: Dict[str, Any]) -> int:
+        return int(item.get(self.entity_type2parent_id[name]) or 0)
+
+    def _rebuild_indexes(self):
+        """
+        Сбрасывает индексы. Индекс типа строится лениво при первом обращении
+        (_ensure_index), чтобы после старта не декодировать весь кэш сразу.
+        """
+        self.children_index = {}
+        self._parent_of = {}
+        self.phone_index = {}
+        self.driver_deliveries = {}
+        self._driver_of = {}
+        self.stage_deliveries = {}
+        self._stage_of = {}
+        self.deal_supplies = {}
+        self._deal_of = {}
+        self._indexed = set()
+
+    def _ensure_index(self, name: str):
+        if name in self._indexed:
+            return
+        with self._lock:
+            if name in self._indexed:
+                return
+            if name == 'contact':
+                for contact_id, contact in self.cache['contact'].items():
+                    self._index_phones(contact_id, None, contact)
+            elif name == 'supply':
+                for supply_id, supply in self.cache['supply'].items():
+                    self._index_supply(supply_id, supply)
+            elif name in self.entity_type2parent_id:
+                for item_id, item in self.cache[name].items():
+                    self._index_entity(name, item_id, item)
+            self._indexed.add(name)
+
+    def _contact_phones(self, contact: Dict[str, Any]) -> List[str]:
+        # В старых кэшах у контакта есть только PHONE (первый номер)
+        return contact.get('PHONES') or [contact.get('PHONE', '')]
+
+    def _index_phones(self, contact_id: int, old: Dict[str, Any] | None, new: Dict[str, Any]):
+        if old is not None:
+            for phone in self._contact_phones(old):
+                key = normalize_phone(phone)
+                if self.phone_index.get(key) == contact_id:
+                    del self.phone_index[key]
+        for phone in self._contact_phones(new):
+            key = normalize_phone(phone)
+            if key:
+                self.phone_index[key] = contact_id
+
+    @staticmethod
+    def _driver_id_of(delivery: Dict[str, Any]) -> int:
+        try:
+            return int(delivery.get('ufCrm6_1729602194') or 0)
+        except (TypeError, ValueError):
+            return 0
+
+    @staticmethod
+    def _move_in_index(index: Dict[Any, set], reverse: Dict[int, Any], item_id: int, key: Any):
+        """
+        Переносит item_id в index под ключ key (key=None - только удаление).
+        """
+        old_key = reverse.pop(item_id, None)
+        if old_key is not None:
+            index[old_key].discard(item_id)
+            if not index[old_key]:
+                del index[old_key]
+        if key is not None:
+            index.setdefault(key, set()).add(item_id)
+            reverse[item_id] = key
+
+    def _index_delivery(self, delivery_id: int, delivery: Dict[str, Any] | None):
+        """
+        Обновляет индексы водителей и стадий для доставки (delivery=None - удаление).
+        """
+        driver_id = (self._driver_id_of(delivery) or None) if delivery is not None else None
+        stage = (delivery.get('stageId') or '') if delivery is not None else None
+        self._move_in_index(self.driver_deliveries, self._driver_of, delivery_id, driver_id)
+        self._move_in_index(self.stage_deliveries, self._stage_of, delivery_id, stage)
+
+    def _index_supply(self, supply_id: int, supply: Dict[str, Any] | None):
+        """
+        Обновляет индекс сделка -> поставки (supply=None - удаление).
+        """
+        deal_id = None
+        if supply is not None:
+            try:
+                deal_id = int(supply.get('UF_CRM_1728985624') or 0) or None
+            except (TypeError, ValueError):
+                deal_id = None
+        self._move_in_index(self.deal_supplies, self._deal_of, supply_id, deal_id)
+
+    def _index_entity(self, name: str, item_id: int, item: Dict[str, Any]):
+        if name == 'delivery':
+            self._index_delivery(item_id, item)
+        elif name == 'supply':
+            self._index_supply(item_id, item)
+        if name not in self.entity_type2parent_id:
+            return
+        index = self.children_index.setdefault(name, defaultdict(set))
+        parents = self._parent_of.setdefault(name, {})
+        new_parent = self._parent_id(name, item)
+        old_parent = parents.get(item_id)
+        if old_parent is not None and old_parent != new_parent:
+            index[old_parent].discard(item_id)
+            if not index[old_parent]:
+                del index[old_parent]
+        index[new_parent].add(item_id)
+        parents[item_id] = new_parent
+
+    def _put_entity(self, name: str, item: Dict[str, Any], item_id: int = None):
+        """
+        Единая точка записи сущности в кэш: обновляет кэш, индексы
+        и помечает затронутые поддеревья вложенной структуры.
+        """
+        if item_id is None:
+            item_id = int(item['id'])
+        item = self._record(name, item)
+        with self._lock:
+            self._ensure_index(name)
+            if self.cache[name].get(item_id) == item:
+                return
+            old = self.cache[name].get(item_id)
+            # Старый родитель тоже теряет поддерево, если сущность переехала
+            self._mark_dirty(name, item_id)
+            self.cache[name][item_id] = item
+            self._changed[name].add(item_id)
+            self.data_version += 1
+            self._index_entity(name, item_id, item)
+            if name == 'contact':
+                self._index_phones(item_id, old, item)
+            self._mark_dirty(name, item_id)
+
+    def _remove_entity(self, name: str, item_id: int):
+        """
+        Удаляет сущность из кэша и индексов; в хранилище удаление уходит
+        со следующим сохранением (id остаётся в _changed).
+        """
+        with self._lock:
+            self._ensure_index(name)
+            old = self.cache[name].get(item_id)
+            if old is None:
+                return
+            self._mark_dirty(name, item_id)
+            del self.cache[name][item_id]
+            self._changed[name].add(item_id)
+            self.data_version += 1
+            parent_id = self._parent_of.get(name, {}).pop(item_id, None)
+            if parent_id is not None:
+                index = self.children_index[name]
+                index[parent_id].discard(item_id)
+                if not index[parent_id]:
+                    del index[parent_id]
+            if name == 'contact':
+                self._index_phones(item_id, old, {})
+            elif name == 'supply':
+                self._index_supply(item_id, None)
+            elif name == 'delivery':
+                self._index_delivery(item_id, None)
+                self._remove_entity('marchrutniy_list', item_id)
+                self._remove_entity('product_rows', item_id)
+
+    def _record(self, name: str, item: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Сущность в виде хранения: компактная запись по схеме или, в сыром режиме, как есть.
+        """
+        return item if self.raw else compact(name, item)
+
+    def _select(self, *names: str) -> List[str]:
+        return select_fields(*names, raw=self.raw)
+
+    def _supply_id_of(self, name: str, item_id: int) -> int | None:
+        """
+        Поднимается по индексам родителей до id поставки.
+        """
+        while name != 'supply':
+            self._ensure_index(name)
+            parent_id = self._parent_of.get(name, {}).get(item_id)
+            if parent_id is None:
+                return None
+            name, item_id = self.entity_type2parent_type[name], parent_id
+        return item_id
+
+    def _mark_dirty(self, name: str, item_id: int):
+        if not self._nested_valid:
+            return
+        if name == 'contact':
+            self._ensure_index('delivery')
+            for delivery_id in list(self.driver_deliveries.get(item_id, ())):
+                self._mark_dirty('delivery', delivery_id)
+        elif name in ('marchrutniy_list', 'product_rows'):
+            self._mark_dirty('delivery', item_id)
+        elif name == 'deal':
+            self._ensure_index('supply')
+            self._dirty_supplies.update(self.deal_supplies.get(item_id, ()))
+        else:
+            supply_id = self._supply_id_of(name, item_id)
+            if supply_id is not None:
+                self._dirty_supplies.add(supply_id)
+
+    def _invalidate_nested(self):
+        """
+        Сбрасывает материализованную структуру целиком (после полной загрузки кэша).
+        """
+        self._nested_valid = False
+        self._dirty_supplies.clear()
+
+    def _children(self, name: str, parent_id: int) -> List[Dict[str, Any]]:
+        """
+        Дочерние сущности типа name для parent_id (в порядке возрастания id).
+        """
+        self._ensure_index(name)
+        child_ids = self.children_index.get(name, {}).get(parent_id)
+        if not child_ids:
+            return []
+        return [self.cache[name][child_id] for child_id in sorted(child_ids) if child_id in self.cache[name]]
+
+    def _first_child(self, name: str, parent_id: int) -> Dict[str, Any] | None:
+        children = self._children(name, parent_id)
+        return children[0] if children else None
+
+    def _call(self, method: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        return self.client.call(method, params)
+
+    def _batch(self, commands: List[Tuple[str, Dict[str, Any]]]) -> List[Dict[str, Any]]:
+        """
+        Выполняет команды через метод batch, по BATCH_LIMIT команд за запрос.
+        Для каждой команды возвращает {'result', 'next', 'total', 'error'} в исходном порядке.
+        """
+        responses = []
+        for chunk_idx, chunk in enumerate(self._chunked(commands, BATCH_LIMIT)):
+            cmd = {
+                f"c{idx}": f"{method.strip('/').removesuffix('.json')}?{urlencode(_flatten_params(params))}"
+                for idx, (method, params) in enumerate(chunk)
+            }
+            for method, _ in chunk:
+                BITRIX_BATCH_COMMANDS.labels(method_name(method)).inc()
+            with tracing.span('batch', chunk=chunk_idx, commands=len(chunk), method=method_name(chunk[0][0])):
+                res = self._call("batch.json", {"halt": 0, "cmd": cmd})
+            if "result" not in res:
+                raise BitrixAPIError("batch", res.get('error'), res.get('error_description', ""))
+            payload = res["result"]
+            # Пустые словари Bitrix отдаёт как []
+            results = payload.get("result") or {}
+            errors = payload.get("result_error") or {}
+            nexts = payload.get("result_next") or {}
+            totals = payload.get("result_total") or {}
+            for key in cmd:
+                responses.append({
+                    'result': results.get(key),
+                    'next': nexts.get(key),
+                    'total': totals.get(key),
+                    'error': errors.get(key)
+                })
+        return responses
+
+    def _paginate_many(self, method: str, params_list: List[Dict[str, Any]], limit: int = 50) -> List[List[Dict[str, Any]]]:
+        """
+        Постраничная выгрузка для нескольких наборов параметров одного метода.
+        Первые страницы всех запросов уходят пачками через batch, затем по
+        result_total сразу планируются все оставшиеся страницы.
+        """
+        pages: List[Dict[int, List[Dict[str, Any]]]] = [{} for _ in params_list]
+        pending = [(idx, 0) for idx in range(len(params_list))]
+        # Запросы, для которых все страницы уже запланированы по result_total
+        scheduled = set()
+        # Число повторов страниц, упавших внутри batch по лимиту запросов
+        attempts: Dict[Tuple[int, int], int] = defaultdict(int)
+        while pending:
+            commands = [
+                (method, {**params_list[idx], 'start': start, 'limit': limit})
+                for idx, start in pending
+            ]
             try:
-                params_with_start = params.copy()
-                params_with_start['start'] = start
-                params_with_start['limit'] = limit
-                res = requests.post(f"{self.webhook_url}/{method}", json=params_with_start).json()
-                result = res.get("result", [])
-                if 'items' in result:
-                    result = result['items']
-                if 'documents' in result:
-                    result = result['documents']
-                if 'productRows' in result:
-                    result = result['productRows']
-
-                all_items.extend(result)
-                if "next" not in res:
-                    break
-                start = res["next"]
+                responses = self._batch(commands)
             except Exception as e:
                 logging.error(f"Ошибка при выполнении {method}: {e}")
+                raise
+
+            next_pending = []
+            throttled = False
+            for (idx, start), response in zip(pending, responses):
+                if response['error']:
+                    _count_error(method, response['error'])
+                    if is_retryable_error(response['error']) and attempts[(idx, start)] < self.client.max_retries:
+                        attempts[(idx, start)] += 1
+                        next_pending.append((idx, start))
+                        throttled = True
+                        continue
+                    logging.error(f"Ошибка при выполнении {method}: {response['error']}")
+                    raise BitrixAPIError(method, response['error'])
+                pages[idx][start] = _extract_items(response['result'])
+                if response['next'] is None or idx in scheduled:
+                    continue
+                next_start = int(response['next'])
+                if response['total']:
+                    step = next_start - start
+                    next_pending.extend((idx, offset) for offset in range(next_start, int(response['total']), step))
+                    scheduled.add(idx)
+                else:
+                    next_pending.append((idx, next_start))
+            pending = next_pending
+            if throttled:
+                self.client.backoff(max(attempts.values()) - 1)
+
+        for idx_pages in pages:
+            BITRIX_PAGES.labels(method_name(method), 'offset').observe(len(idx_pages))
+        return [
+            [item for start in sorted(idx_pages) for item in idx_pages[start]]
+            for idx_pages in pages
+        ]
+
+    def _paginate_parallel(self, method: str, params_list: List[Dict[str, Any]], limit: int = 50) -> List[List[Dict[str, Any]]]:
+        """
+        _paginate_many, разбитый на группы по BATCH_LIMIT запросов, которые
+        выполняются параллельно (не больше load_concurrency). Частоту запросов
+        по-прежнему ограничивает token bucket клиента.
+        """
+        groups = list(self._chunked(params_list, BATCH_LIMIT))
+        if len(groups) <= 1:
+            return self._paginate_many(method, params_list, limit=limit)
+        parent = tracing.current_span()
+
+        def run(indexed_group):
+            group_idx, group = indexed_group
+            with tracing.span('paginate_group', parent=parent, method=method_name(method), group=group_idx):
+                return self._paginate_many(method, group, limit=limit)
+
+        with ThreadPoolExecutor(max_workers=self.load_concurrency, thread_name_prefix="bitrix-pages") as executor:
+            parts = executor.map(run, enumerate(groups))
+            return [result for part in parts for result in part]
+
+    def _paginate_list(
+        self,
+        method: str,
+        params: Dict[str, Any],
+        limit: int = 50,
+        keyset: bool = False,
+        id_field: str = 'ID'
+    ) -> List[Dict[str, Any]]:
+        if keyset:
+            return self._paginate_keyset(method, params, limit=limit, id_field=id_field)
+        return self._paginate_many(method, [params], limit=limit)[0]
+
+    def _paginate_keyset(self, method: str, params: Dict[str, Any], limit: int = 50, id_field: str = 'ID') -> List[Dict[str, Any]]:
+        """
+        Keyset-пагинация: сортировка по id, фильтр >id от последнего увиденного
+        и start=-1, чтобы Bitrix не считал total. Стоимость страницы не растёт
+        с глубиной выборки, поэтому режим для больших списков.
+        id_field - имя поля id у метода ('ID' для crm.deal.list, 'id' для crm.item.list).
+        """
+        all_items = []
+        last_id = 0
+        pages = 0
+        while True:
+            page_params = {
+                **params,
+                'order': {id_field: 'ASC'},
+                'filter': {**params.get('filter', {}), f'>{id_field}': last_id},
+                'start': -1,
+                'limit': limit
+            }
+            res = self._call(method, page_params)
+            if 'error' in res:
+                _count_error(method, res['error'])
+                logging.error(f"Ошибка при выполнении {method}: {res}")
+                raise BitrixAPIError(method, res.get('error'), res.get('error_description', ""))
+            pages += 1
+            items = _extract_items(res.get('result'))
+            all_items.extend(items)
+            if len(items) < KEYSET_PAGE_SIZE:
                 break
+            last_id = int(items[-1][id_field])
+        BITRIX_PAGES.labels(method_name(method), 'keyset').observe(pages)
         return all_items
     
-    def download_urls(self, document_name, limit: int = 50):
-       ent_ids_list = [val['id'] for val in self.cache[document_name].values() if 'id' in val]
-       print(document_name, len(self.cache[document_name]), len(ent_ids_list), ent_ids_list[:10])
-       documents_list = self._paginate_list('/crm.documentgenerator.document.list', 
-              params={
-                  'entityTypeId': self.entity_type_ids[document_name], 
-                  'filter': {
-                      'id': ent_ids_list
-                  },
-                  'order': {'id': 'asc'}},
-                limit=limit
-        )
-       print(len(documents_list))
-       for item in documents_list:
-           self.cache[document_name][int(item['id'])]['downloadUrl'] = item['pdfUrl']
-        
+    def download_urls(self, document_name, ids: List[int] = None, limit: int = 50) -> Dict[int, str | None]:
+        """
+        Разрешает ссылки на PDF документов ids (по умолчанию всех документов типа)
+        в кэш document_urls. Уже закэшированные ссылки повторно не запрашиваются.
+        Поддеревья документов с новыми ссылками помечаются к пересборке.
+        """
+        if ids is None:
+            ids = [int(val['id']) for val in self.cache[document_name].values() if 'id' in val]
+        ent_ids_list = [int(doc_id) for doc_id in ids if (document_name, int(doc_id)) not in self.document_urls]
+        urls: Dict[int, str | None] = dict.fromkeys(ent_ids_list)
+        if ent_ids_list:
+            params_list = [
+                {
+                    'entityTypeId': self.entity_type_ids[document_name],
+                    'filter': {
+                        'id': chunk
+                    },
+                    'order': {'id': 'asc'}
+                }
+                for chunk in self._chunked(ent_ids_list, limit)
+            ]
+            for part in self._paginate_parallel('/crm.documentgenerator.document.list', params_list, limit=limit):
+                for item in part:
+                    urls[int(item['id'])] = item['pdfUrl']
+            with self._lock:
+                for doc_id, url in urls.items():
+                    self.document_urls.set((document_name, doc_id), url)
+                    self._mark_dirty(document_name, doc_id)
+                self.data_version += 1
+        return urls
+
+    def _with_document_url(self, name: str, document: Dict[str, Any] | None) -> Dict[str, Any] | None:
+        """
+        Документ со ссылкой на PDF из кэша document_urls (без запросов в Bitrix).
+        """
+        if document is None:
+            return None
+        url = self.document_urls.get((name, int(document['id'])))
+        return {**document, 'downloadUrl': url} if url is not None else document
+
+    def prefetch_document_urls(self):
+        """
+        Заранее разрешает ссылки на документы активных доставок (не SUCCESS/FAIL),
+        пачками; ссылки остальных документов разрешаются при первом обращении.
+        """
+        with self._lock:
+            active = [delivery_id for delivery_id, delivery in self.cache['delivery'].items() if _is_active(delivery)]
+            ids = {
+                name: [int(doc['id']) for delivery_id in active for doc in self._children(name, delivery_id)]
+                for name in DOCUMENT_TYPES
+            }
+        for name, doc_ids in ids.items():
+            self._report_progress(f'{name}_urls', documents=len(doc_ids))
+            self.download_urls(name, ids=doc_ids)
+
     def get_delivery_full_info_by_id(self, delivery_id: int) -> Dict[str, Any]:
         """
         Возвращает полную информацию по доставке:
@@ -106,7 +783,34 @@ class BitrixDeliveryManager:
         - накладная, доверенность, маршрутный лист
         - товары
         - родительская отгрузка, закупка и сделка
+        Ссылки на документы, которых ещё нет в кэше, разрешаются запросом в Bitrix
+        (вне блокировки кэша). Если Bitrix недоступен, документ возвращается
+        без downloadUrl: ссылка на PDF не должна ломать выдачу доставки.
+        """
+        info = self._delivery_full_info(delivery_id)
+        for name in DOCUMENT_TYPES:
+            document = info[name]
+            if document is not None and (name, int(document['id'])) not in self.document_urls:
+                try:
+                    self.download_urls(name, ids=[int(document['id'])])
+                except Exception as e:
+                    logging.error(f"Не удалось получить ссылку на {name} #{document['id']}: {e}")
+                    continue
+                info[name] = self._with_document_url(name, document)
+        return info
+
+    @_locked
+    def get_delivery_driver(self, delivery_id: int) -> Dict[str, Any] | None:
+        """
+        Контакт водителя доставки из кэша (без разрешения ссылок на документы).
         """
+        delivery = self.cache['delivery'].get(delivery_id)
+        if not delivery:
+            raise ValueError(f"Доставка с id={delivery_id} не найдена в кэше.")
+        return self.cache['contact'].get(self._driver_id_of(delivery))
+
+    @_locked
+    def _delivery_full_info(self, delivery_id: int) -> Dict[str, Any]:
         delivery = self.cache['delivery'].get(delivery_id)
         if not delivery:
             raise ValueError(f"Доставка с id={delivery_id} не найдена в кэше.")
@@ -116,18 +820,12 @@ class BitrixDeliveryManager:
         driver = self.cache['contact'].get(int(driver_id)) if driver_id else None
 
         # Загрузка и разгрузка
-        loading = next((l for l in self.cache['loading'].values()
-                        if int(l.get('parentId1048', 0)) == delivery_id), None)
-
-        unloading = next((u for u in self.cache['unloading'].values()
-                        if int(u.get('parentId1048', 0)) == delivery_id), None)
+        loading = self._first_child('loading', delivery_id)
+        unloading = self._first_child('unloading', delivery_id)
 
         # Документы
-        nacladnaya = next((n for n in self.cache['nacladnaya'].values()
-                        if int(n.get('parentId1048', 0)) == delivery_id), None)
-
-        doverennost = next((d for d in self.cache['doverennost'].values()
-                            if int(d.get('parentId1048', 0)) == delivery_id), None)
+        nacladnaya = self._with_document_url('nacladnaya', self._first_child('nacladnaya', delivery_id))
+        doverennost = self._with_document_url('doverennost', self._first_child('doverennost', delivery_id))
 
         marchrutniy_list = self.cache['marchrutniy_list'].get(delivery_id)
 
@@ -148,13 +846,10 @@ class BitrixDeliveryManager:
         if supply:
             deal_id = supply.get('UF_CRM_1728985624')
             if deal_id:
-                deal = self.cache['deal'].get(deal_id)
+                deal = self.cache['deal'].get(int(deal_id))
 
         # Связанные закупки
-        purchases = [
-            p for p in self.cache['purchase'].values()
-            if int(p.get('parentId1040', 0)) == shipment_id
-        ]
+        purchases = self._children('purchase', shipment_id)
 
         return {
             "delivery": delivery,
@@ -168,89 +863,139 @@ class BitrixDeliveryManager:
             "supply": supply,
             "deal": deal,
             "purchases": purchases,
-            "product_rows": delivery.get("product_rows", [])
+            "product_rows": self._product_rows(delivery_id, delivery)
         }
 
     def load_supplies(self, limit: int = 50):
+        """
+        Полная загрузка кэша как граф стадий. Критический путь:
+        поставки -> отгрузки -> доставки, всё, что зависит только от id доставок
+        (загрузка, разгрузка, документы, товары, водители), выполняется параллельно.
+        Ссылки на PDF документов в загрузку не входят (prefetch_document_urls, download_urls).
+        """
+        started = datetime.now(timezone.utc)
+        delivery_ids = lambda: list(self.cache['delivery'].keys())
+        stages = [
+            Stage('supply', lambda: self._load_supply_list(limit=limit)),
+            Stage('deal', lambda: self._load_deals_from_supplies(limit=limit), deps=['supply']),
+            Stage('shipment', lambda: self._fetch_specific_entities(
+                'shipment', list(self.cache['supply'].keys()), "parentId2", limit=limit), deps=['supply']),
+            Stage('delivery', lambda: self._fetch_specific_entities(
+                'delivery', list(self.cache['shipment'].keys()), "parentId1040", limit=limit), deps=['shipment']),
+            Stage('purchase', lambda: self._fetch_specific_entities(
+                'purchase', list(self.cache['shipment'].keys()), "parentId1040", limit=limit), deps=['shipment']),
+            Stage('marchrutniy_list', self._build_marchrutniy_list, deps=['delivery']),
+            Stage('contact', lambda: self._load_driver_contacts_from_deliveries(limit=limit), deps=['delivery']),
+            Stage('loading', lambda: self._fetch_specific_entities(
+                'loading', delivery_ids(), "parentId1048", limit=limit), deps=['delivery']),
+            Stage('unloading', lambda: self._fetch_specific_entities(
+                'unloading', delivery_ids(), "parentId1048", limit=limit), deps=['delivery']),
+            Stage('nacladnaya', lambda: self._fetch_specific_entities(
+                'nacladnaya', delivery_ids(), 'parentId1048', limit=limit), deps=['delivery']),
+            Stage('doverennost', lambda: self._fetch_specific_entities(
+                'doverennost', delivery_ids(), "parentId1048", limit=limit), deps=['delivery']),
+            Stage('product_rows', lambda: self._get_products_for_deliveries(delivery_ids()), deps=['delivery']),
+        ]
+        with tracing.trace('load'), track_sync('load'):
+            for stage in stages:
+                stage.func = self._tracked('load', stage.name, stage.func)
+            run_stage_graph(
+                stages,
+                max_workers=self.load_concurrency,
+                on_stage_done=lambda name, done, total: self._report_progress(name, done=done, total=total)
+            )
+        self._invalidate_nested()
+        self._full_save_needed = True
+        self.data_version += 1
+        # Полная загрузка - точка отсчёта для всех последующих дельт
+        self.watermarks = {kind: started.isoformat() for kind in self._delta_kinds()}
+        self.deletions_checked_at = started.isoformat()
+
+    def _load_supply_list(self, limit: int = 50):
         print("Загружаем поставки (сделки с названием, начинающимся с 'Поставка')...")
         items = self._paginate_list("crm.deal.list.json", {
             "filter": {"title": "%Поставка%"},
             'order': {'ID': 'ASC'},
-            "select": ["*", "UF_*"],
+            "select": self._select('supply'),
             "limit": limit
-        })
+        }, keyset=True)
         supplies = [item for item in items if item.get("TITLE", "").startswith("Поставка")]
-        self.cache['supply'] = {int(item['ID']): item for item in supplies}
+        self.cache['supply'] = {int(item['ID']): self._record('supply', item) for item in supplies}
         print(f"Загружено поставок: {len(supplies)}")
-        self._load_deals_from_supplies(limit=limit)
 
-        self._fetch_specific_entities('shipment', list(self.cache['supply'].keys()), "parentId2", limit=limit)
-        self._fetch_specific_entities('delivery', list(self.cache['shipment'].keys()), "parentId1040", limit=limit)
+    @staticmethod
+    def _marchrutniy_entry(delivery: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            'downloadUrl': (
+                (delivery or {}).get('ufCrm6_1729602373', {}) or {}).get('url', None)
+        }
+
+    def _build_marchrutniy_list(self):
         self.cache['marchrutniy_list'] = {
-            key: {
-                'downloadUrl': (
-                    (val or {}).get('ufCrm6_1729602373', {}) or {}).get('url', None)
-            }
+            key: self._marchrutniy_entry(val)
             for key, val in self.cache['delivery'].items()
         }
-        self._fetch_specific_entities('purchase', list(self.cache['shipment'].keys()), "parentId1040", limit=limit)
-
-        self._load_driver_contacts_from_deliveries(limit=limit)
-
-        self._fetch_specific_entities('loading', list(self.cache['delivery'].keys()), "parentId1048", limit=limit)
-        self._fetch_specific_entities('unloading', list(self.cache['delivery'].keys()), "parentId1048", limit=limit)
-        self._fetch_specific_entities('nacladnaya', list(self.cache['delivery'].keys()), 'parentId1048', limit=limit)
-        self.download_urls('nacladnaya')
-        self._fetch_specific_entities('doverennost', list(self.cache['delivery'].keys()), "parentId1048", limit=limit)
-        self.download_urls('doverennost')
-
-        self._get_products_for_deliveries(list(self.cache['delivery'].keys()))
 
     def _load_deals_from_supplies(self, limit: int = 50):
         deal_ids = [
             val['UF_CRM_1728985624'] 
             for _, val in self.cache['supply'].items()
         ]
-        params = {
-            'filter': {
-                'ID': deal_ids
-            },
-            'order': {'ID': 'ASC'},
-            "select": ["*", "UF_*"]
-        }
         self.cache['deal'] = {
-            item["ID"]: item for item in self._paginate_list("crm.deal.list.json", params, limit=limit)
+            int(item["ID"]): self._record('deal', item) for item in self._fetch_deals(deal_ids, limit=limit)
         }
+
+    def _fetch_deals(self, deal_ids: List[Any], limit: int = 50) -> List[Dict[str, Any]]:
+        params_list = [
+            {
+                'filter': {
+                    'ID': chunk
+                },
+                'order': {'ID': 'ASC'},
+                "select": self._select('deal')
+            }
+            for chunk in self._chunked(deal_ids, limit)
+        ]
+        return [
+            item
+            for part in self._paginate_many("crm.deal.list.json", params_list, limit=limit)
+            for item in part
+        ]
     
     def _get_products_for_deliveries(self, ids, limit: int = 50):
-        product_rows = self._paginate_list(
-            '/crm.item.productrow.list', 
+        """
+        Товары доставок ids: фильтр =ownerId пачками по limit доставок, пачки
+        выгружаются параллельно. Результат пишется в отдельную таблицу
+        product_rows (delivery_id -> позиции), у доставок без товаров запись удаляется.
+        """
+        ids = [int(del_id) for del_id in ids]
+        params_list = [
             {
                 "filter" : {
                     "=ownerType" : f"T{hex(self.entity_type_ids['delivery'])[2:]}", ## 1048
-                    "=ownerId" : ids
+                    "=ownerId" : chunk
                 }
-            }, limit=limit)
-
-        grouped = defaultdict(list)
-        for item in product_rows:
-            key = item['ownerId']
-            grouped[key].append(item)
-        grouped = dict(grouped)
-        self.cache['delivery'] = {
-            del_id: {
-                **delivery,
-                'product_rows': [
-                    {
-                        'product_name': item['productName'],
-                        'quantity': item['quantity'],
-                        'unit': item['measureName']
-                    }
-                    for item in grouped[delivery['id']]
-                ]
             }
-            for del_id, delivery in self.cache['delivery'].items()
-        }
+            for chunk in self._chunked(ids, limit)
+        ]
+        grouped = defaultdict(list)
+        for part in self._paginate_parallel('/crm.item.productrow.list', params_list, limit=limit):
+            for item in part:
+                grouped[int(item['ownerId'])].append({
+                    'product_name': item['productName'],
+                    'quantity': item['quantity'],
+                    'unit': item['measureName']
+                })
+
+        for del_id in ids:
+            if grouped.get(del_id):
+                self._put_entity('product_rows', grouped[del_id], item_id=del_id)
+            else:
+                self._remove_entity('product_rows', del_id)
+
+    def _product_rows(self, delivery_id: int, delivery: Dict[str, Any]) -> List[Dict[str, Any]]:
+        # В кэшах прежнего формата товары лежат внутри доставки
+        return self.cache['product_rows'].get(delivery_id) or delivery.get('product_rows', [])
 
     def _load_driver_contacts_from_deliveries(self, limit: int = 50):
         # Сбор всех уникальных ID контактов водителей из поля ufCrm6_1729602194 в deliveries
@@ -268,300 +1013,674 @@ class BitrixDeliveryManager:
             return
 
         print(f"Загружаем данные контактов водителей: {len(driver_contact_ids)} шт.")
+        contacts = self._fetch_contacts(driver_contact_ids, limit=limit)
+        print(f"Загружено контактов водителей: {len(contacts)}")
 
-        # Запрашиваем контакты пачками по 50 (лимит API)
-        for chunk in self._chunked(list(driver_contact_ids), 50):
-            params = {
-                "filter": {"ID": chunk},
-                "select": ["*", "PHONE", "EMAIL"]
-            }
+    def _driver_ids(self) -> set:
+        driver_ids = set()
+        for delivery in self.cache['delivery'].values():
             try:
-                contacts = self._paginate_list("crm.contact.list.json", params, limit=limit)
-                for c in contacts:
-                    cur_cont = c.copy()
-                    if "PHONE" in cur_cont:
-                        cur_cont['PHONE'] = cur_cont['PHONE'][0]['VALUE'].replace('+', '')
-                    else:
-                        cur_cont['PHONE'] = ""
-                    self.cache['contact'][int(c['ID'])] = cur_cont
-                print(f"Загружено контактов водителей: {len(contacts)}")
-            except Exception as e:
-                print(f"Ошибка при загрузке контактов водителей: {e}")
+                driver_id = int(delivery.get('ufCrm6_1729602194') or 0)
+            except ValueError:
+                continue
+            if driver_id:
+                driver_ids.add(driver_id)
+        return driver_ids
+
+    def _fetch_contacts(self, contact_ids, extra_filter: Dict[str, Any] = None, limit: int = 50) -> List[Dict[str, Any]]:
+        """
+        Выгружает контакты по id (с дополнительным фильтром, например по DATE_MODIFY)
+        и записывает их в кэш. Возвращает выгруженные контакты.
+        """
+        # Запрашиваем контакты пачками по 50 (лимит API), пачки уходят через batch
+        params_list = [
+            {
+                "filter": {**(extra_filter or {}), "ID": chunk},
+                "select": self._select('contact')
+            }
+            for chunk in self._chunked(list(contact_ids), 50)
+        ]
+        # Ошибки выгрузки не глушим: лучше упасть, чем сохранить неполный список
+        contacts = [
+            c
+            for part in self._paginate_many("crm.contact.list.json", params_list, limit=limit)
+            for c in part
+        ]
+        for c in contacts:
+            cur_cont = c.copy()
+            # PHONE - первый номер (как раньше), PHONES - все номера контакта
+            phones = [p['VALUE'].replace('+', '') for p in cur_cont.get('PHONE') or [] if p.get('VALUE')]
+            cur_cont['PHONE'] = phones[0] if phones else ""
+            cur_cont['PHONES'] = phones
+            self._put_entity('contact', cur_cont, item_id=int(c['ID']))
+        return contacts
 
     def _fetch_specific_entities(self, name: str, ids: set, filter_key: str, limit: int = 50):
         entity_type_id = self.entity_type_ids[name]
+        params_list = [
+            {
+                "entityTypeId": entity_type_id,
+                "filter": {filter_key: chunk} if filter_key else {},
+                'order': {'ID': 'ASC'},
+                "select": self._select(name)
+            }
+            for chunk in self._chunked(list(ids), limit)
+        ]
         items = []
-        for chunk in self._chunked(list(ids), limit):
-            try:
-                params = {
-                    "entityTypeId": entity_type_id,
-                    "filter": {filter_key: chunk} if filter_key else {},
-                    'order': {'ID': 'ASC'},
-                    "select": ["*", "UF_*"]
-                }
-                #res = requests.post(f"{self.webhook_url}/crm.item.list.json", json=params).json()
-                part_items = self._paginate_list("crm.item.list.json", params, limit=limit)
-                items.extend(part_items['items'] if 'items' in part_items else part_items)
-                print(f"Загружено {name} {len(items)} из {len(ids)}")
-            except Exception as e:
-                print(f"Ошибка при загрузке {name}: {e}")
-        self.cache[name].update({int(item['id']): item for item in items})
+        for part_items in self._paginate_many("crm.item.list.json", params_list, limit=limit):
+            items.extend(part_items)
+        print(f"Загружено {name} {len(items)} по {len(ids)} родителям")
+        for item in items:
+            self._put_entity(name, item)
 
     def _chunked(self, iterable, n):
         for i in range(0, len(iterable), n):
             yield iterable[i:i+n]
     
+    @_locked
     def build_nested_structure(self) -> Dict[int, Dict[str, Any]]:
-        structure = {}
-
-        for supply_id, supply in self.cache['supply'].items():
-            structure[supply_id] = {
-                'supply': supply,
-                'deal': self.cache['deal'].get(supply.get('UF_CRM_1728985624')),
-                'shipments': []
+        """
+        Возвращает материализованную структуру поставка -> отгрузки -> доставка.
+        Пересобираются только поддеревья поставок, затронутые изменениями с прошлого вызова.
+        Возвращается поверхностная копия: её можно сериализовать, пока кэш обновляется.
+        Поддеревья с истёкшими ссылками на документы тоже пересобираются.
+        """
+        self.document_urls.expire()
+        for name, doc_id in self.document_urls.drain_expired():
+            self._mark_dirty(name, doc_id)
+        if not self._nested_valid:
+            self._nested = {
+                supply_id: self._build_supply_subtree(supply_id, supply)
+                for supply_id, supply in self.cache['supply'].items()
             }
+            self._dirty_supplies.clear()
+            self._nested_valid = True
+            return dict(self._nested)
 
-            for shipment in self.cache['shipment'].values():
-                if int(shipment.get('parentId2', 0)) != supply_id:
-                    continue
+        for supply_id in self._dirty_supplies:
+            supply = self.cache['supply'].get(supply_id)
+            if supply is None:
+                self._nested.pop(supply_id, None)
+            else:
+                self._nested[supply_id] = self._build_supply_subtree(supply_id, supply)
+        self._dirty_supplies.clear()
+        return dict(self._nested)
+
+    def iter_nested_structure(
+        self,
+        after: int = None,
+        supply_from: int = None,
+        supply_to: int = None,
+        stage: str = None,
+        modified_since: datetime = None
+    ) -> Iterator[Tuple[int, Dict[str, Any]]]:
+        """
+        Поддеревья поставок по возрастанию id с фильтрами (supply_subtree_matches)
+        и курсором after - id последней отданной поставки. Поддеревья отдаются
+        по одному из материализованной структуры, без сборки общего ответа.
+        """
+        nested = self.build_nested_structure()
+        for supply_id in sorted(nested):
+            if after is not None and supply_id <= after:
+                continue
+            if supply_from is not None and supply_id < supply_from:
+                continue
+            if supply_to is not None and supply_id > supply_to:
+                break
+            subtree = nested[supply_id]
+            if supply_subtree_matches(subtree, stage=stage, modified_since=modified_since):
+                yield supply_id, subtree
 
-                shipment_id = int(shipment['id'])
-
-                delivery = next(
-                    (d for d in self.cache['delivery'].values() if int(d.get('parentId1040', 0)) == shipment_id),
-                    None
-                )
-
-                delivery_id = int(delivery['id']) if delivery else None
-
-                delivery_data = None
-                if delivery:
-                    delivery_data = {
-                        'delivery': delivery,
-                        'loading': next(
-                            (l for l in self.cache['loading'].values()
-                            if int(l.get('parentId1048', 0)) == delivery_id), None),
-                        'unloading': next(
-                            (u for u in self.cache['unloading'].values()
-                            if int(u.get('parentId1048', 0)) == delivery_id), None),
-                        'nacladnaya': next(
-                            (n for n in self.cache['nacladnaya'].values()
-                            if int(n.get('parentId1048', 0)) == delivery_id), None),
-                        'doverennost': next(
-                            (d for d in self.cache['doverennost'].values()
-                            if int(d.get('parentId1048', 0)) == delivery_id), None),
-                        'marchrutniy_list': self.cache['marchrutniy_list'].get(delivery_id),
-                        'contact': self.cache['contact'].get(
-                            int(delivery.get('ufCrm6_1729602194') or 0), None),
-                        'product_rows': delivery.get('product_rows', [])
-                    }
-
-                purchases = [
-                    p for p in self.cache['purchase'].values()
-                    if int(p.get('parentId1040', 0)) == shipment_id
-                ]
-
-                structure[supply_id]['shipments'].append({
-                    'shipment': shipment,
-                    'delivery_block': delivery_data,
-                    'purchases': purchases
-                })
+    @_locked
+    def snapshot_cache(self) -> Dict[str, Dict[int, Dict[str, Any]]]:
+        """
+        Поверхностная копия кэша для отдачи наружу во время фонового обновления.
+        """
+        return {name: dict(items) for name, items in self.cache.items()}
 
-        return structure
-    
+    def _build_supply_subtree(self, supply_id: int, supply: Dict[str, Any]) -> Dict[str, Any]:
+        subtree = {
+            'supply': supply,
+            'deal': self.cache['deal'].get(int(supply.get('UF_CRM_1728985624') or 0)),
+            'shipments': []
+        }
+
+        for shipment in self._children('shipment', supply_id):
+            shipment_id = int(shipment['id'])
+
+            delivery = self._first_child('delivery', shipment_id)
+
+            delivery_id = int(delivery['id']) if delivery else None
+
+            delivery_data = self._delivery_block(delivery_id, delivery) if delivery else None
+
+            purchases = self._children('purchase', shipment_id)
+
+            subtree['shipments'].append({
+                'shipment': shipment,
+                'delivery_block': delivery_data,
+                'purchases': purchases
+            })
+
+        return subtree
+
+    def _delivery_block(self, delivery_id: int, delivery: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            'delivery': delivery,
+            'loading': self._first_child('loading', delivery_id),
+            'unloading': self._first_child('unloading', delivery_id),
+            'nacladnaya': self._with_document_url('nacladnaya', self._first_child('nacladnaya', delivery_id)),
+            'doverennost': self._with_document_url('doverennost', self._first_child('doverennost', delivery_id)),
+            'marchrutniy_list': self.cache['marchrutniy_list'].get(delivery_id),
+            'contact': self.cache['contact'].get(self._driver_id_of(delivery), None),
+            'product_rows': self._product_rows(delivery_id, delivery)
+        }
+
+    def _structure_position(self, delivery_id: int) -> Tuple[int, int] | None:
+        """
+        (id поставки, id отгрузки), под которыми доставка стоит во вложенной структуре,
+        или None, если структура её не показывает: нет отгрузки или поставки в кэше,
+        либо у отгрузки есть доставка с меньшим id (в структуру попадает первая).
+        """
+        self._ensure_index('shipment')
+        shipment_id = self._parent_of.get('delivery', {}).get(delivery_id)
+        if shipment_id is None or shipment_id not in self.cache['shipment']:
+            return None
+        supply_id = self._parent_of.get('shipment', {}).get(shipment_id)
+        if supply_id is None or supply_id not in self.cache['supply']:
+            return None
+        first = min(
+            (child_id for child_id in self.children_index['delivery'].get(shipment_id, ()) if child_id in self.cache['delivery']),
+            default=None
+        )
+        return (supply_id, shipment_id) if first == delivery_id else None
+
+    def _active_delivery_ids(self, active: bool = True) -> set:
+        """
+        id активных (не SUCCESS/FAIL) или, при active=False, закрытых доставок по индексу стадий.
+        """
+        self._ensure_index('delivery')
+        return set().union(*(
+            ids for stage, ids in self.stage_deliveries.items() if _is_active_stage(stage) == active
+        ))
+
+    @_locked
+    def delivery_driver_ids(self) -> List[int]:
+        """
+        id водителей, у которых есть доставки, по возрастанию.
+        """
+        self._ensure_index('delivery')
+        return sorted(self.driver_deliveries)
+
+    @_locked
     def get_deliveries_grouped_by_driver(self, search_driver_id = None, is_active_deliveries=True) -> Dict[int, Dict[str, Any]]:
         """
         Возвращает deliveries, сгруппированные по водителям.
         Структура: {driver_id: {"contact": contact_info, "deliveries": [delivery_info, ...]}}
+        Доставки берутся из индексов водителей и стадий, вложенная структура не пересобирается.
         """
-        grouped = defaultdict(lambda: {"contact": None, "deliveries": []})
-        
-        nested = self.build_nested_structure()
-        for supply in nested.values():
-            for shipment_entry in supply["shipments"]:
-                delivery_block = shipment_entry.get("delivery_block")
-                if not delivery_block:
-                    continue
-
-                delivery = delivery_block.get("delivery")
-                contact = delivery_block.get("contact")
-                if not delivery or not contact:
-                    continue
-                if is_active_deliveries and ('SUCCESS' in delivery['stageId'] or 'FAIL' in delivery['stageId']):
-                    continue
-
-                driver_id = int(contact["ID"])
-                grouped[driver_id]["contact"] = contact
-                grouped[driver_id]["deliveries"].append(delivery_block)
+        self._ensure_index('delivery')
+        active = self._active_delivery_ids() if is_active_deliveries else None
+        if search_driver_id is not None:
+            driver_ids = self.driver_deliveries.get(search_driver_id, set())
+            by_driver = {search_driver_id: driver_ids & active if active is not None else driver_ids}
+        elif active is not None:
+            by_driver = defaultdict(list)
+            for delivery_id in active:
+                driver_id = self._driver_of.get(delivery_id)
+                if driver_id is not None:
+                    by_driver[driver_id].append(delivery_id)
+        else:
+            by_driver = self.driver_deliveries
+
+        grouped = {}
+        for driver_id in sorted(by_driver):
+            contact = self.cache['contact'].get(driver_id)
+            if contact is None:
+                continue
+            positions = []
+            for delivery_id in by_driver[driver_id]:
+                delivery = self.cache['delivery'].get(delivery_id)
+                position = self._structure_position(delivery_id) if delivery is not None else None
+                if position is not None:
+                    positions.append((position, delivery_id, delivery))
+            if positions:
+                grouped[driver_id] = {
+                    "contact": contact,
+                    "deliveries": [
+                        self._delivery_block(delivery_id, delivery)
+                        for _, delivery_id, delivery in sorted(positions, key=lambda entry: entry[0])
+                    ]
+                }
 
-        grouped = dict(grouped)
         if search_driver_id is not None:
             return grouped.get(search_driver_id, {})
         else:
             return grouped
-    
-    def build_nested_structure_old(self) -> Dict[int, Dict[str, Any]]:
-        structure = {}
-
-        for supply_id, supply in self.cache['supply'].items():
-            structure[supply_id] = {
-                'supply': supply,
-                'deal': self.cache['deal'].get(supply.get('UF_CRM_1728985624')),
-                'shipments': []
-            }
 
-            for shipment in self.cache['shipment'].values():
-                if int(shipment.get('parentId2', 0)) != supply_id:
+    @_locked
+    def query_deliveries(
+        self,
+        stages: List[str] = None,
+        driver_id: int = None,
+        active: bool = None,
+        date_from: datetime = None,
+        date_to: datetime = None,
+        date_field: str = 'createdTime'
+    ) -> List[Dict[str, Any]]:
+        """
+        Блоки доставок (как во вложенной структуре) по фильтрам: набор стадий,
+        водитель, активность и окно [date_from, date_to] по полю date_field.
+        Кандидаты берутся пересечением индексов стадий и водителей, поэтому
+        стоимость запроса пропорциональна числу подходящих доставок.
+        date_field - одно из DELIVERY_DATE_FIELDS, иначе ValueError.
+        """
+        if date_field not in DELIVERY_DATE_FIELDS:
+            raise ValueError(f"Фильтр по дате возможен только по полям {', '.join(DELIVERY_DATE_FIELDS)}")
+        self._ensure_index('delivery')
+        candidates = []
+        if stages:
+            candidates.append(set().union(*(self.stage_deliveries.get(stage, set()) for stage in stages)))
+        if active is not None:
+            candidates.append(self._active_delivery_ids(active))
+        if driver_id is not None:
+            candidates.append(self.driver_deliveries.get(driver_id, set()))
+        if candidates:
+            candidates.sort(key=len)
+            ids = candidates[0].intersection(*candidates[1:])
+        else:
+            ids = self.cache['delivery'].keys()
+
+        date_from, date_to = _parse_time(date_from), _parse_time(date_to)
+        blocks = []
+        for delivery_id in sorted(ids):
+            delivery = self.cache['delivery'].get(delivery_id)
+            if delivery is None:
+                continue
+            if date_from is not None or date_to is not None:
+                moment = _parse_time(delivery.get(date_field))
+                if moment is None or (date_from is not None and moment < date_from) \
+                        or (date_to is not None and moment > date_to):
                     continue
+            blocks.append(self._delivery_block(delivery_id, delivery))
+        return blocks
+
+    def _delta_kinds(self) -> List[str]:
+        # 'deal' - общая выгрузка crm.deal.list для поставок и связанных сделок
+        return ['deal', 'contact', *self.entity_type_ids.keys()]
+
+    def _parent_delta_kind(self, kind: str) -> str | None:
+        # Поставки приходят в общей выгрузке сделок
+        parent = self.entity_type2parent_type.get(kind)
+        return 'deal' if parent == 'supply' else parent
+
+    def _delta_since(self, kind: str, since: datetime = None) -> str:
+        if since is None:
+            watermark = self.watermarks.get(kind)
+            if watermark is None:
+                since = datetime.now(timezone.utc) - DEFAULT_LOOKBACK
+            else:
+                since = datetime.fromisoformat(watermark) - self.watermark_overlap
+        return since.isoformat()
 
-                shipment_id = int(shipment['id'])
-
-                # Найдём единственную delivery
-                delivery = next(
-                    (d for d in self.cache['delivery'].values() if int(d.get('parentId1040', 0)) == shipment_id),
-                    None
-                )
-
-                # Найдём loading/unloading, если delivery существует
-                loading = None
-                unloading = None
-                contact = None
-                if delivery:
-                    delivery_id = int(delivery['id'])
-                    loading = next(
-                        (l for l in self.cache['loading'].values() if int(l.get('parentId1048', 0)) == delivery_id),
-                        None
-                    )
-                    unloading = next(
-                        (u for u in self.cache['unloading'].values() if int(u.get('parentId1048', 0)) == delivery_id),
-                        None
-                    )
+    def refresh_updates(self, since: datetime = None):
+        """
+        Дельта-синхронизация по водяным знакам: для каждого вида выгрузки берутся
+        записи с DATE_MODIFY не раньше прошлой успешной выгрузки (с перекрытием
+        watermark_overlap). Для изменённых доставок дополнительно обновляются
+        маршрутные листы и товары, ссылки на PDF изменённых документов сбрасываются
+        и для активных доставок разрешаются заново.
+        Удаления сверяются по спискам id раз в deletion_check_interval.
+        Водяной знак вида сдвигается, только если его выгрузка и выгрузки видов
+        выше по иерархии прошли без ошибок: элементы без родителя в кэше
+        отбрасываются и должны попасть в следующую дельту.
+        since задаёт начало окна явно для всех видов.
+        Если хоть одна стадия упала, после сохранения выбрасывается RefreshError,
+        и запуск считается неуспешным (метрики, статус задачи).
+        """
+        with tracing.trace('refresh'), track_sync('refresh'):
+            self._refresh_updates(since)
+
+    def _refresh_updates(self, since: datetime = None):
+        changed: Dict[str, set] = defaultdict(set)
+        watermarks = dict(self.watermarks)
+        # Виды, чья выгрузка (или выгрузка родителя) не удалась в этом запуске
+        failed: set = set()
+        # Стадии, завершившиеся ошибкой
+        errors: List[str] = []
+
+        def delta(kind: str, fetch: Callable[[str], None]):
+            started = datetime.now(timezone.utc)
+            iso_time = self._delta_since(kind, since)
+            parent_kind = self._parent_delta_kind(kind)
+            try:
+                print(f"Обновляем {kind} с {iso_time}...")
+                self._report_progress(kind)
+                with _sync_stage('refresh', kind):
+                    fetch(iso_time)
+                if parent_kind in failed:
+                    failed.add(kind)
+                    print(f"Водяной знак {kind} не сдвинут: не обновился {parent_kind}")
+                else:
+                    self.watermarks[kind] = started.isoformat()
+            except Exception as e:
+                failed.add(kind)
+                errors.append(kind)
+                print(f"Ошибка при обновлении {kind}: {e}")
 
-                    contact = next(
-                        (u for u in self.cache['contact'].values() if int(u.get('ID', 0)) == int(delivery.get('ufCrm6_1729602194', 0) or 0)),
-                        None
-                    )
+        delta('deal', lambda iso_time: self._refresh_deals(iso_time))
+        for name in self.entity_type_ids:
+            delta(name, lambda iso_time, name=name: changed[name].update(self._refresh_items(name, iso_time)))
 
-                # Найдём все закупки
-                purchases = [
-                    purchase for purchase in self.cache['purchase'].values()
-                    if int(purchase.get('parentId1040', 0)) == shipment_id
-                ]
-
-                shipment_entry = {
-                    'shipment': shipment,
-                    'delivery': {
-                        'delivery': delivery,
-                        'loading': loading,
-                        'unloading': unloading,
-                        'contact': contact if contact else None
-                    } if delivery else None,
-                    'purchases': purchases
-                }
+        delivery_ids = sorted(changed['delivery'])
+        for delivery_id in delivery_ids:
+            delivery = self.cache['delivery'].get(delivery_id)
+            if delivery is not None:
+                self._put_entity('marchrutniy_list', self._marchrutniy_entry(delivery), item_id=delivery_id)
 
-                structure[supply_id]['shipments'].append(shipment_entry)
+        delta('contact', self._refresh_contacts)
 
-        return structure
+        # Изменённый документ мог быть перегенерирован: его ссылка разрешится заново
+        for name in DOCUMENT_TYPES:
+            for doc_id in changed[name]:
+                self.document_urls.pop((name, doc_id))
 
-    def refresh_updates(self, since: datetime):
-        iso_time = since.isoformat()
-        self._load_driver_contacts_from_deliveries(limit=50)
-        self.update_deliveries()
-        print(f"Обновление всех сущностей с {iso_time}...")
-        for name in self.entity_type_ids.keys():
-            entity_type_id = self.entity_type_ids[name]
-            try:
-                print(f"Обновляем {name}...")
-                updated_items = self._paginate_list("crm.item.list.json", {
-                    "entityTypeId": entity_type_id,
-                    "filter": {">=DATE_MODIFY": iso_time},
-                })
-                for item in updated_items:
-                    self.cache[name][int(item['id'])] = item
-            except Exception as e:
-                print(f"Ошибка при обновлении {name}: {e}")
-        self._save_cache_to_file()
+        # Товары выгружаются по id изменённых доставок: если это не удалось,
+        # водяной знак доставок откатывается, чтобы повторить их в следующий раз
+        try:
+            if delivery_ids:
+                self._report_progress('product_rows', deliveries=len(delivery_ids))
+                with _sync_stage('refresh', 'product_rows'):
+                    self._get_products_for_deliveries(delivery_ids)
+        except Exception as e:
+            errors.append('product_rows')
+            print(f"Ошибка при обновлении товаров: {e}")
+            if watermarks.get('delivery') is None:
+                self.watermarks.pop('delivery', None)
+            else:
+                self.watermarks['delivery'] = watermarks['delivery']
+
+        try:
+            with _sync_stage('refresh', 'document_urls'):
+                self.prefetch_document_urls()
+        except Exception as e:
+            errors.append('document_urls')
+            print(f"Ошибка при получении ссылок на документы: {e}")
+
+        try:
+            with _sync_stage('refresh', 'deletions'):
+                self._reconcile_deletions()
+        except Exception as e:
+            errors.append('deletions')
+            print(f"Ошибка при сверке удалений: {e}")
+        self._report_progress('save')
+        try:
+            with _sync_stage('refresh', 'save'):
+                self._save_cache_to_file(raise_errors=True)
+        except Exception:
+            errors.append('save')
+        if errors:
+            raise RefreshError(errors)
+
+    def _refresh_deals(self, iso_time: str):
+        """
+        Изменённые сделки: поставки (по названию) и сделки, связанные с поставками.
+        Сделки, на которые поставки начали ссылаться, догружаются по id.
+        """
+        items = self._paginate_list("crm.deal.list.json", {
+            "filter": {">=DATE_MODIFY": iso_time},
+            "select": self._select('supply', 'deal')
+        }, keyset=True)
+        for item in items:
+            if item.get("TITLE", "").startswith("Поставка"):
+                self._put_entity('supply', item, item_id=int(item['ID']))
+
+        linked = {
+            int(supply['UF_CRM_1728985624'])
+            for supply in self.cache['supply'].values() if supply.get('UF_CRM_1728985624')
+        }
+        for item in items:
+            if int(item['ID']) in linked:
+                self._put_entity('deal', item, item_id=int(item['ID']))
+        missing = [deal_id for deal_id in linked if deal_id not in self.cache['deal']]
+        for item in self._fetch_deals(missing) if missing else []:
+            self._put_entity('deal', item, item_id=int(item['ID']))
+
+    def _refresh_items(self, name: str, iso_time: str) -> List[int]:
+        """
+        Изменённые элементы типа name. Берутся только элементы, уже известные кэшу
+        или привязанные к известному родителю (типы обходятся сверху вниз).
+        Возвращает id записанных элементов.
+        """
+        parent_cache = self.cache[self.entity_type2parent_type[name]]
+        items = [
+            item
+            for item in self._paginate_list("crm.item.list.json", {
+                "entityTypeId": self.entity_type_ids[name],
+                "filter": {">=DATE_MODIFY": iso_time},
+                "select": self._select(name)
+            }, keyset=True, id_field='id')
+            if int(item['id']) in self.cache[name] or self._parent_id(name, item) in parent_cache
+        ]
+        if name == 'delivery':
+            self.update_deliveries(items)
+        else:
+            for item in items:
+                self._put_entity(name, item)
+        return [int(item['id']) for item in items]
+
+    def _refresh_contacts(self, iso_time: str):
+        driver_ids = self._driver_ids()
+        missing = [driver_id for driver_id in driver_ids if driver_id not in self.cache['contact']]
+        if missing:
+            self._fetch_contacts(missing)
+        known = [driver_id for driver_id in driver_ids if driver_id in self.cache['contact']]
+        if known:
+            self._fetch_contacts(known, {">=DATE_MODIFY": iso_time})
+
+    def _existing_ids(self, name: str, ids: List[int], limit: int = 50) -> set:
+        """
+        Какие из ids ещё существуют в Bitrix: списки только с полем id,
+        пачками по limit id через batch.
+        """
+        if name in self.entity_type_ids:
+            method, id_field = "crm.item.list.json", 'id'
+            base = {"entityTypeId": self.entity_type_ids[name]}
+        else:
+            method, id_field = ("crm.contact.list.json" if name == 'contact' else "crm.deal.list.json"), 'ID'
+            base = {}
+        params_list = [
+            {**base, "filter": {id_field: chunk}, "select": [id_field]}
+            for chunk in self._chunked(list(ids), limit)
+        ]
+        return {
+            int(item[id_field])
+            for part in self._paginate_many(method, params_list, limit=limit)
+            for item in part
+        }
+
+    def _reconcile_deletions(self):
+        """
+        Удаляет из кэша сущности, которых больше нет в Bitrix.
+        Выполняется не чаще deletion_check_interval. Ошибки выгрузки пробрасываются,
+        время сверки при этом не сдвигается.
+        """
+        now = datetime.now(timezone.utc)
+        if self.deletions_checked_at is not None:
+            elapsed = now - datetime.fromisoformat(self.deletions_checked_at)
+            if elapsed.total_seconds() < self.deletion_check_interval:
+                return
+        self._report_progress('deletions')
+        removed = 0
+        for name in ('supply', 'deal', 'contact', *self.entity_type_ids.keys()):
+            cached = list(self.cache[name].keys())
+            existing = self._existing_ids(name, cached)
+            for item_id in cached:
+                if item_id not in existing:
+                    self._remove_entity(name, item_id)
+                    removed += 1
+        self.deletions_checked_at = now.isoformat()
+        print(f"Сверка удалений: удалено {removed}")
+
+    async def arefresh_updates(self, since: datetime = None):
+        """
+        Асинхронная обёртка: обновление выполняется в потоке, не блокируя event loop.
+        """
+        return await asyncio.to_thread(self.refresh_updates, since)
     
-    def update_deliveries(self):
-        updated_items = self._paginate_list("crm.item.list.json", {
-            "entityTypeId": self.entity_type_ids['delivery']
+    def update_deliveries(self, items: List[Dict[str, Any]] = None):
+        """
+        Сравнивает свежие доставки с прошлым снимком в кэше и уведомляет n8n
+        о переходах (назначен водитель, готовы документы). Работа линейна
+        по числу изменённых доставок, снимок в кэше сразу обновляется.
+        items - уже выгруженные изменённые доставки, без них выгружаются все.
+        """
+        if items is None:
+            items = self._paginate_list("crm.item.list.json", {
+                "entityTypeId": self.entity_type_ids['delivery'],
+                "select": self._select('delivery')
+            }, keyset=True, id_field='id')
+        with tracing.span('update_deliveries', deliveries=len(items)):
+            events = detect_changes(self.cache['delivery'], items)
+            for item in items:
+                self._put_entity('delivery', item)
+        self._enqueue_notifications(events)
+
+    def notify_changes_since(self, previous: 'BitrixDeliveryManager'):
+        """
+        Ставит в очередь уведомления о переходах доставок между кэшем
+        previous (менеджер до полной перезагрузки) и текущим: переходы после
+        последней дельты и во время загрузки иначе остались бы незамеченными.
+        """
+        with previous._lock:
+            old = dict(previous.cache['delivery'])
+        with self._lock:
+            items = list(self.cache['delivery'].values())
+        self._enqueue_notifications(detect_changes(old, items))
+
+    def _enqueue_notifications(self, events):
+        for event in events:
+            if event.notification_mode is None:
+                continue
+            # Отправкой занимается воркер outbox, обновление кэша его не ждёт
+            self.outbox.enqueue(event.delivery_id, event.driver_id, event.notification_mode, transition=event.updated_at)
+
+    def _copy_type(self, name: str) -> Dict[int, Any]:
+        with self._lock:
+            return dict(self.cache[name])
+
+    def _save_snapshot(self) -> Dict[str, Dict[int, Any]]:
+        """
+        Снимок кэша для сохранения (вызывается под self._lock): копии уже
+        загруженных типов; незагруженные остаются ленивыми, чтобы хранилище
+        могло перенести их без декодирования.
+        """
+        if not isinstance(self.cache, LazyCache):
+            return {name: dict(items) for name, items in self.cache.items()}
+        snapshot = LazyCache({
+            name: (lambda name=name: self._copy_type(name))
+            for name in self.cache if not self.cache.is_loaded(name)
         })
-        NAZNACHENIE_DRIVER_STAGE = 'DT1048_9:1'
-        SEND_DOCUMENTS_STAGE = 'DT1048_9:4'
-        if len(updated_items) > 0:
-            for item in updated_items:
-                mode = None
-                delivery_id = int(item['id'])
-                old_delivery = self.cache['delivery'].get(delivery_id)
-
-                driver_id = item.get('ufCrm6_1729602194')
-                if not driver_id or item['stageId'] not in [SEND_DOCUMENTS_STAGE, NAZNACHENIE_DRIVER_STAGE]:
-                    continue
+        for name in list(self.cache):
+            if self.cache.is_loaded(name):
+                snapshot[name] = dict(self.cache[name])
+        return snapshot
 
-                if item['stageId'] == NAZNACHENIE_DRIVER_STAGE:
-                    mode = 'new_delivery_for_driver'
-                if item['stageId'] == SEND_DOCUMENTS_STAGE:
-                    mode = 'send_documents'
-
-                grouped = self.get_deliveries_grouped_by_driver(int(driver_id))
-                already_has = any(
-                    d['delivery']['id'] == delivery_id for d in grouped.get('deliveries', [])
-                )
-                already_was_the_status = any(
-                    d['delivery']['stageId'] == SEND_DOCUMENTS_STAGE for d in grouped.get('deliveries', [])
-                )
-
-                if not already_has or not already_was_the_status:
-                    try:
-                        print(item)
-                        response = requests.post(
-                            'https://n8n.glavsnabstroymsk.ru/webhook-test/send_information_about_new_deliveries',
-                            json={"delivery_id": delivery_id, "driver_id": driver_id, 'mode': mode}
-                        )
-                        logging.info(f"Доставка {delivery_id} {self.entity_type_ids['delivery']} {driver_id} отправлена в n8n {response.text}")
-                    except Exception as e:
-                        try:
-                            response = requests.post(
-                                'https://n8n.glavsnabstroymsk.ru/webhook/send_information_about_new_deliveries',
-                                json={"delivery_id": delivery_id, "driver_id": driver_id, 'mode': mode}
-                            )
-                        except Exception as e:
-                            logging.error(f"Ошибка при POST в n8n: {e}")
-
-    def _save_cache_to_file(self):
+    def _save_cache_to_file(self, raise_errors: bool = False):
+        """
+        Сохраняет кэш в хранилище: после полной загрузки - целиком,
+        иначе только сущности, изменённые с прошлого сохранения.
+        Под блокировкой снимается только снимок, сериализация и запись идут
+        без неё, чтобы не задерживать чтения. При ошибке изменения
+        возвращаются в очередь следующего сохранения, а исключение
+        пробрасывается только при raise_errors.
+        """
+        with self._lock:
+            full = self._full_save_needed
+            changed = {name: set(ids) for name, ids in self._changed.items() if ids}
+            snapshot = self._save_snapshot()
+            changes = {
+                name: {item_id: snapshot[name].get(item_id) for item_id in ids}
+                for name, ids in changed.items()
+            }
+            meta = {
+                'watermarks': dict(self.watermarks),
+                'deletions_checked_at': self.deletions_checked_at
+            }
+            self._changed.clear()
+            self._full_save_needed = False
         try:
-            with open(self.cache_file, "w", encoding="utf-8") as f:
-                json.dump(self.cache, f, ensure_ascii=False, indent=4)
+            if full:
+                self.store.save_all(snapshot)
+            elif changes:
+                self.store.save_changes(changes, snapshot)
+            # Водяные знаки пишутся после данных: при падении между ними дельта повторится
+            self.store.save_meta(meta)
             print(f"Кэш сохранён в {self.cache_file}")
         except Exception as e:
             print(f"Ошибка при сохранении кэша: {e}")
-
-    def _load_cache_from_file(self):
+            with self._lock:
+                for name, ids in changed.items():
+                    self._changed[name].update(ids)
+                self._full_save_needed = self._full_save_needed or full
+            if raise_errors:
+                raise
+
+    def _load_cache_from_file(self) -> bool:
+        """
+        Загружает кэш из хранилища. При ошибке возвращает False,
+        и менеджер собирает кэш заново вместо работы с частичными данными.
+        """
         try:
-            with open(self.cache_file, "r", encoding="utf-8") as f:
-                loaded = json.load(f)
-                self.cache = {
-                    k: {int(inner_k): inner_v for inner_k, inner_v in v.items()} for k, v in loaded.items()
-                }
+            loaded = self.store.load()
         except Exception as e:
             print(f"Ошибка при загрузке кэша: {e}")
+            return False
+        # Хранилище может вернуть LazyCache: типы декодируются при первом обращении
+        for name in self.cache:
+            if name not in loaded:
+                loaded[name] = {}
+        if not self.raw:
+            if isinstance(loaded, LazyCache):
+                loaded.map_types(compact_items)
+            else:
+                for name in list(loaded):
+                    loaded[name] = compact_items(name, loaded[name])
+        self.cache = loaded
+        return True
     
-    def get_driver_id_by_phone(self, phone_number: str) -> int | None:
+    def _load_meta(self):
+        try:
+            meta = self.store.load_meta()
+        except Exception as e:
+            print(f"Ошибка при загрузке водяных знаков: {e}")
+            return
+        self.watermarks = dict(meta.get('watermarks') or {})
+        self.deletions_checked_at = meta.get('deletions_checked_at')
+
+    def close(self):
         """
-        Поиск driver_id (Bitrix Contact ID) по номеру телефона.
-        Номер приводится к виду, с которым сравниваются контакты.
+        Закрывает пул соединений с Bitrix (менеджер, заменённый полной перезагрузкой).
         """
-        def normalize(p: str) -> str:
-            # удалим всё кроме цифр, например: +7 (999) 123-45-67 → 79991234567
-            return ''.join(filter(str.isdigit, p))
+        self.client.close()
 
-        target = normalize(phone_number)
-
-        for driver_id, driver in self.cache['contact'].items():
-            if normalize(driver.get("PHONE", "")) == target:
-                return driver_id
+    def cache_sizes(self) -> Dict[str, int]:
+        """
+        Число записей по типам кэша. Типы, которые хранилище ещё не декодировало,
+        пропускаются, чтобы сбор метрик не загружал их.
+        """
+        cache = self.cache
+        if isinstance(cache, LazyCache):
+            return {name: len(cache[name]) for name in list(cache) if cache.is_loaded(name)}
+        return {name: len(items) for name, items in cache.items()}
 
-        return None
+    def get_driver_id_by_phone(self, phone_number: str) -> int | None:
+        """
+        Поиск driver_id (Bitrix Contact ID) по номеру телефона.
+        Номер нормализуется (normalize_phone) и ищется в индексе по всем номерам контактов.
+        """
+        self._ensure_index('contact')
+        return self.phone_index.get(normalize_phone(phone_number))
     
     def move_entity_to_stage(self, entity_name: str, entity_id: int, new_stage_id: str) -> bool:
         """
@@ -577,7 +1696,6 @@ class BitrixDeliveryManager:
             return False
 
         entity_type_id = self.entity_type_ids[entity_name]
-        url = f"{self.webhook_url}/crm.item.update.json"
 
         payload = {
             "entityTypeId": entity_type_id,
@@ -588,17 +1706,23 @@ class BitrixDeliveryManager:
         }
 
         try:
-            response = requests.post(url, json=payload)
-            result = response.json()
+            result = self.client.call("crm.item.update.json", payload)
             if 'result' in result:
                 logging.info(f"{entity_name} #{entity_id} перемещён в stage {new_stage_id}")
                 # Обновим локальный кэш
                 if entity_name in self.cache and entity_id in self.cache[entity_name]:
-                    self.cache[entity_name][entity_id]['stageId'] = new_stage_id
+                    self._put_entity(
+                        entity_name,
+                        {**self.cache[entity_name][entity_id], 'stageId': new_stage_id},
+                        item_id=entity_id
+                    )
                 return True
             else:
                 logging.warning(f"Ошибка при обновлении stageId: {result}")
                 return False
         except Exception as e:
             logging.error(f"Ошибка при перемещении объекта: {e}")
-            return False
\ No newline at end of file
+            return False
+
+    async def amove_entity_to_stage(self, entity_name: str, entity_id: int, new_stage_id: str) -> bool:
+        return await asyncio.to_thread(self.move_entity_to_stage, entity_name, entity_id, new_stage_id)
@@ -0,0 +1,386 @@
+import json
+import logging
+import mmap
+import os
+import sqlite3
+import struct
+import tempfile
+import threading
+from contextlib import closing
+from typing import Any, Callable, Dict
+
+from webservice.src.entity_schema import jsonable
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+Cache = Dict[str, Dict[int, Any]]
+# {entity_type: {id: item}}, item=None означает удаление строки
+Changes = Dict[str, Dict[int, Any]]
+
+SNAPSHOT_MAGIC = b"BXS1"
+
+
+def _dumps(obj: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj, default=jsonable)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=jsonable).encode("utf-8")
+
+
+def _loads(data: bytes | str) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _atomic_write(path: str, data: bytes):
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class LazyCache(dict):
+    """
+    Словарь {тип сущности: {id: item}}, в котором тип декодируется из
+    хранилища только при первом обращении к нему. Полный обход
+    (items/values, сериализация) загружает все оставшиеся типы.
+    """
+    def __init__(self, loaders: Dict[str, Callable[[], Dict[int, Any]]]):
+        super().__init__()
+        self._loaders = dict(loaders)
+        self._load_lock = threading.Lock()
+
+    def __missing__(self, key):
+        with self._load_lock:
+            if dict.__contains__(self, key):
+                return dict.__getitem__(self, key)
+            loader = self._loaders.get(key)
+            if loader is None:
+                raise KeyError(key)
+            value = loader()
+            dict.__setitem__(self, key, value)
+            del self._loaders[key]
+            return value
+
+    def is_loaded(self, key: str) -> bool:
+        return dict.__contains__(self, key)
+
+    def _load_all(self):
+        for key in list(self._loaders):
+            self[key]
+
+    def __setitem__(self, key, value):
+        with self._load_lock:
+            self._loaders.pop(key, None)
+            dict.__setitem__(self, key, value)
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self._loaders
+
+    def __iter__(self):
+        return iter(list(dict.keys(self)) + list(self._loaders))
+
+    def __len__(self):
+        return dict.__len__(self) + len(self._loaders)
+
+    def keys(self):
+        return list(self)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def items(self):
+        self._load_all()
+        return dict.items(self)
+
+    def values(self):
+        self._load_all()
+        return dict.values(self)
+
+    def map_types(self, func: Callable[[str, Dict[int, Any]], Dict[int, Any]]):
+        """
+        Применяет func(тип, items) к уже загруженным типам и ко всем,
+        которые загрузятся позже (например, упаковка в компактные записи).
+        """
+        with self._load_lock:
+            for key in list(dict.keys(self)):
+                dict.__setitem__(self, key, func(key, dict.__getitem__(self, key)))
+            self._loaders = {
+                key: (lambda key=key, loader=loader: func(key, loader()))
+                for key, loader in self._loaders.items()
+            }
+
+
+class CacheStore:
+    """
+    Хранилище кэша BitrixDeliveryManager.
+    save_all пишет кэш целиком, save_changes - только изменённые строки.
+    """
+    def exists(self) -> bool:
+        raise NotImplementedError
+
+    def load(self) -> Cache:
+        raise NotImplementedError
+
+    def save_all(self, cache: Cache):
+        raise NotImplementedError
+
+    def save_changes(self, changes: Changes, cache: Cache):
+        raise NotImplementedError
+
+    # Служебные значения (водяные знаки синхронизации) - по умолчанию в соседнем JSON-файле
+    def _meta_path(self) -> str:
+        return self.path + ".meta.json"
+
+    def load_meta(self) -> Dict[str, Any]:
+        try:
+            with open(self._meta_path(), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def save_meta(self, meta: Dict[str, Any]):
+        _atomic_write(self._meta_path(), json.dumps(meta, ensure_ascii=False).encode("utf-8"))
+
+
+class JsonCacheStore(CacheStore):
+    """
+    Прежний формат: весь кэш одним JSON-файлом. Запись атомарная
+    (временный файл + os.replace), но всегда целиком.
+    """
+    def __init__(self, path: str):
+        self.path = path
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def load(self) -> Cache:
+        with open(self.path, "r", encoding="utf-8") as f:
+            loaded = json.load(f)
+        return {
+            k: {int(inner_k): inner_v for inner_k, inner_v in v.items()} for k, v in loaded.items()
+        }
+
+    def save_all(self, cache: Cache):
+        _atomic_write(self.path, json.dumps(cache, ensure_ascii=False, default=jsonable).encode("utf-8"))
+
+    def save_changes(self, changes: Changes, cache: Cache):
+        self.save_all(cache)
+
+
+class SqliteCacheStore(CacheStore):
+    """
+    SQLite: по таблице на тип сущности, строка на сущность (id, JSON).
+    Изменения пишутся upsert'ом одной транзакцией, WAL защищает от порчи при падении.
+    База считается кэшем, только если в ней есть отметка завершённого save_all
+    (пишется в той же транзакции): файл после прерванной первой записи - не кэш.
+    Если кэша ещё нет, но есть JSON-кэш прежнего формата, он импортируется при загрузке.
+    """
+    # Ключ meta: полный кэш записан хотя бы раз
+    COMPLETE_KEY = "complete"
+
+    def __init__(self, path: str, legacy_json_file: str = None):
+        self.path = path
+        self.legacy_json_file = legacy_json_file
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS entity_types (name TEXT PRIMARY KEY)")
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        return conn
+
+    def load_meta(self) -> Dict[str, Any]:
+        if not os.path.exists(self.path):
+            return {}
+        with closing(self._connect()) as conn:
+            return {key: json.loads(value) for key, value in conn.execute("SELECT key, value FROM meta")}
+
+    def save_meta(self, meta: Dict[str, Any]):
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                "INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                ((key, json.dumps(value)) for key, value in meta.items())
+            )
+
+    @staticmethod
+    def _table(name: str) -> str:
+        return f'"entity_{name}"'
+
+    def _ensure_table(self, conn: sqlite3.Connection, name: str):
+        conn.execute(f"CREATE TABLE IF NOT EXISTS {self._table(name)} (id INTEGER PRIMARY KEY, data BLOB NOT NULL)")
+        conn.execute("INSERT OR IGNORE INTO entity_types (name) VALUES (?)", (name,))
+
+    def _complete(self) -> bool:
+        if not os.path.exists(self.path):
+            return False
+        with closing(self._connect()) as conn:
+            return conn.execute("SELECT 1 FROM meta WHERE key = ?", (self.COMPLETE_KEY,)).fetchone() is not None
+
+    def _has_legacy(self) -> bool:
+        return bool(self.legacy_json_file) and os.path.exists(self.legacy_json_file)
+
+    def exists(self) -> bool:
+        return self._complete() or self._has_legacy()
+
+    def load(self) -> Cache:
+        if not self._complete():
+            if not self._has_legacy():
+                raise FileNotFoundError(f"{self.path}: полный кэш ещё не сохранялся")
+            logging.info(f"Импорт кэша из {self.legacy_json_file} в {self.path}")
+            cache = JsonCacheStore(self.legacy_json_file).load()
+            self.save_all(cache)
+            return cache
+
+        with closing(self._connect()) as conn:
+            names = [row[0] for row in conn.execute("SELECT name FROM entity_types")]
+        return LazyCache({name: (lambda name=name: self._load_table(name)) for name in names})
+
+    def _load_table(self, name: str) -> Dict[int, Any]:
+        with closing(self._connect()) as conn:
+            return {
+                item_id: _loads(data)
+                for item_id, data in conn.execute(f"SELECT id, data FROM {self._table(name)}")
+            }
+
+    def save_all(self, cache: Cache):
+        with closing(self._connect()) as conn, conn:
+            # Таблицы создаются в той же транзакции, что и данные с отметкой
+            conn.execute("BEGIN")
+            for name, items in cache.items():
+                self._ensure_table(conn, name)
+                conn.execute(f"DELETE FROM {self._table(name)}")
+                conn.executemany(
+                    f"INSERT INTO {self._table(name)} (id, data) VALUES (?, ?)",
+                    ((item_id, _dumps(item)) for item_id, item in items.items())
+                )
+            conn.execute(
+                "INSERT INTO meta (key, value) VALUES (?, 'true') ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                (self.COMPLETE_KEY,)
+            )
+
+    def save_changes(self, changes: Changes, cache: Cache):
+        with closing(self._connect()) as conn, conn:
+            for name, items in changes.items():
+                self._ensure_table(conn, name)
+                deleted = [(item_id,) for item_id, item in items.items() if item is None]
+                if deleted:
+                    conn.executemany(f"DELETE FROM {self._table(name)} WHERE id = ?", deleted)
+                conn.executemany(
+                    f"INSERT INTO {self._table(name)} (id, data) VALUES (?, ?) "
+                    f"ON CONFLICT(id) DO UPDATE SET data = excluded.data",
+                    (
+                        (item_id, _dumps(item))
+                        for item_id, item in items.items() if item is not None
+                    )
+                )
+
+
+class SnapshotCacheStore(CacheStore):
+    """
+    Компактный бинарный снимок для быстрого старта:
+    MAGIC | uint32 длина заголовка | заголовок {тип: [offset, length]} | сегменты.
+    Сегмент - JSON-массив пар [id, item] (orjson, если установлен).
+    Файл отображается в память (mmap), сегмент типа декодируется при первом обращении.
+    При сохранении сегменты незагруженных и неизменённых типов копируются как есть.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._mmap: mmap.mmap | None = None
+        self._header: Dict[str, list] = {}
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def _open(self):
+        with open(self.path, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if mapped[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            mapped.close()
+            raise ValueError(f"{self.path} не является снимком кэша")
+        header_start = len(SNAPSHOT_MAGIC) + 4
+        (header_len,) = struct.unpack("<I", mapped[len(SNAPSHOT_MAGIC):header_start])
+        self._header = _loads(mapped[header_start:header_start + header_len])
+        self._data_start = header_start + header_len
+        self._mmap = mapped
+
+    def _segment(self, name: str) -> bytes:
+        offset, length = self._header[name]
+        start = self._data_start + offset
+        return self._mmap[start:start + length]
+
+    def _decode(self, mapped: mmap.mmap, start: int, length: int) -> Dict[int, Any]:
+        return {item_id: item for item_id, item in _loads(mapped[start:start + length])}
+
+    def load(self) -> Cache:
+        self._open()
+        mapped, data_start = self._mmap, self._data_start
+        return LazyCache({
+            name: (lambda offset=offset, length=length: self._decode(mapped, data_start + offset, length))
+            for name, (offset, length) in self._header.items()
+        })
+
+    def _write(self, segments: Dict[str, bytes]):
+        header, offset = {}, 0
+        for name, data in segments.items():
+            header[name] = [offset, len(data)]
+            offset += len(data)
+        header_bytes = _dumps(header)
+        _atomic_write(self.path, b"".join([
+            SNAPSHOT_MAGIC, struct.pack("<I", len(header_bytes)), header_bytes, *segments.values()
+        ]))
+        # Старое отображение остаётся валидным для ещё не загруженных типов
+        self._open()
+
+    @staticmethod
+    def _encode(items: Dict[int, Any]) -> bytes:
+        return _dumps([[item_id, item] for item_id, item in items.items()])
+
+    def save_all(self, cache: Cache):
+        self._write({name: self._encode(items) for name, items in cache.items()})
+
+    def save_changes(self, changes: Changes, cache: Cache):
+        segments = {}
+        for name in cache:
+            unloaded = isinstance(cache, LazyCache) and not cache.is_loaded(name)
+            if unloaded and name not in changes and self._mmap is not None and name in self._header:
+                segments[name] = self._segment(name)
+            else:
+                segments[name] = self._encode(cache[name])
+        self._write(segments)
+
+
+def make_cache_store(cache_file: str, backend: str = None) -> CacheStore:
+    """
+    Создаёт хранилище кэша. backend: 'sqlite' (по умолчанию), 'snapshot' или 'json',
+    можно задать через BITRIX_CACHE_BACKEND. Для sqlite и snapshot файл *.json
+    из BITRIX_CACHE_FILE становится *.sqlite3 / *.snapshot, а для sqlite сам
+    JSON - источником импорта.
+    """
+    backend = backend or os.environ.get("BITRIX_CACHE_BACKEND", "sqlite")
+    if backend == "json":
+        return JsonCacheStore(cache_file)
+    if backend == "sqlite":
+        root, ext = os.path.splitext(cache_file)
+        if ext == ".json":
+            return SqliteCacheStore(root + ".sqlite3", legacy_json_file=cache_file)
+        return SqliteCacheStore(cache_file)
+    if backend == "snapshot":
+        root, ext = os.path.splitext(cache_file)
+        return SnapshotCacheStore(root + ".snapshot" if ext == ".json" else cache_file)
+    raise ValueError(f"Неизвестный тип хранилища кэша: {backend}")
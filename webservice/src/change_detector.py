@@ -0,0 +1,99 @@
+from dataclasses import dataclass
+from enum import Enum
+from typing import Any, Dict, Iterable, List
+
+DRIVER_FIELD = 'ufCrm6_1729602194'
+NAZNACHENIE_DRIVER_STAGE = 'DT1048_9:1'
+SEND_DOCUMENTS_STAGE = 'DT1048_9:4'
+
+# Поля доставки, изменения которых порождают события
+WATCHED_FIELDS = ('stageId', DRIVER_FIELD)
+
+
+class DeliveryEventType(str, Enum):
+    CREATED = 'created'
+    STAGE_CHANGED = 'stage_changed'
+    DRIVER_CHANGED = 'driver_changed'
+    # Доставка попала на стадию назначения водителя (или сменился водитель на этой стадии)
+    DRIVER_ASSIGNED = 'driver_assigned'
+    # Доставка перешла на стадию отправки документов водителю
+    DOCUMENTS_READY = 'documents_ready'
+
+
+# Режим уведомления n8n для событий, о которых нужно сообщить водителю
+NOTIFICATION_MODES = {
+    DeliveryEventType.DRIVER_ASSIGNED: 'new_delivery_for_driver',
+    DeliveryEventType.DOCUMENTS_READY: 'send_documents',
+}
+
+
+@dataclass(frozen=True)
+class DeliveryEvent:
+    type: DeliveryEventType
+    delivery_id: int
+    driver_id: int | None
+    old_stage: str | None
+    new_stage: str | None
+    old_driver_id: int | None = None
+    # updatedTime доставки в момент перехода: отличает повтор того же перехода от нового
+    updated_at: str | None = None
+
+    @property
+    def notification_mode(self) -> str | None:
+        return NOTIFICATION_MODES.get(self.type)
+
+
+def _driver(item: Dict[str, Any] | None) -> int | None:
+    value = (item or {}).get(DRIVER_FIELD)
+    try:
+        return int(value) if value else None
+    except (TypeError, ValueError):
+        return None
+
+
+def diff_delivery(old: Dict[str, Any] | None, new: Dict[str, Any]) -> List[DeliveryEvent]:
+    """
+    Сравнивает прошлый и новый снимок доставки по WATCHED_FIELDS
+    и возвращает события переходов.
+    """
+    if old is not None and all(old.get(f) == new.get(f) for f in WATCHED_FIELDS):
+        return []
+
+    delivery_id = int(new['id'])
+    old_stage = old.get('stageId') if old else None
+    new_stage = new.get('stageId')
+    old_driver, new_driver = _driver(old), _driver(new)
+
+    def event(event_type: DeliveryEventType) -> DeliveryEvent:
+        return DeliveryEvent(
+            event_type, delivery_id, new_driver, old_stage, new_stage, old_driver,
+            updated_at=str(new['updatedTime']) if new.get('updatedTime') else None
+        )
+
+    events = []
+    if old is None:
+        events.append(event(DeliveryEventType.CREATED))
+    else:
+        if old_stage != new_stage:
+            events.append(event(DeliveryEventType.STAGE_CHANGED))
+        if old_driver != new_driver:
+            events.append(event(DeliveryEventType.DRIVER_CHANGED))
+
+    if new_driver is not None:
+        entered = old_stage != new_stage
+        if new_stage == NAZNACHENIE_DRIVER_STAGE and (entered or old_driver != new_driver):
+            events.append(event(DeliveryEventType.DRIVER_ASSIGNED))
+        if new_stage == SEND_DOCUMENTS_STAGE and (entered or old_driver != new_driver):
+            events.append(event(DeliveryEventType.DOCUMENTS_READY))
+    return events
+
+
+def detect_changes(previous: Dict[int, Dict[str, Any]], items: Iterable[Dict[str, Any]]) -> List[DeliveryEvent]:
+    """
+    События по всем изменённым доставкам: previous - прошлый снимок {id: delivery},
+    items - свежие данные. Неизменённые доставки отсекаются сравнением двух полей.
+    """
+    events = []
+    for item in items:
+        events.extend(diff_delivery(previous.get(int(item['id'])), item))
+    return events
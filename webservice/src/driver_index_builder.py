@@ -1,9 +1,16 @@
 import os
-from typing import Any, Dict
-from webservice.src.bitrix_delivery_manager import BitrixDeliveryManager
+from bisect import bisect_right
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Tuple
+from webservice.src.bitrix_delivery_manager import BitrixDeliveryManager, delivery_block_matches
 
 
 class DriverIndexBuilder:
+    """
+    Пути к блокам доставок водителей во вложенной структуре.
+    Эндпоинты используют индекс водителей менеджера (driver_deliveries),
+    класс оставлен для внешних скриптов.
+    """
     def __init__(self, delivery_manager: BitrixDeliveryManager):
         self.delivery_manager = delivery_manager
         self.cache = delivery_manager.cache
@@ -14,7 +21,7 @@ class DriverIndexBuilder:
 
         for supply_id, supply_data in structure.items():
             for shipment_idx, shipment_entry in enumerate(supply_data['shipments']):
-                delivery_block = shipment_entry.get('delivery')
+                delivery_block = shipment_entry.get('delivery_block')
 
                 if not delivery_block:
                     continue
@@ -25,7 +32,7 @@ class DriverIndexBuilder:
                     driver_id = int(driver['ID'])
                     driver_index.setdefault(driver_id, [])
                     driver_index[driver_id].append(
-                        (supply_id, 'shipments', shipment_idx, 'delivery')
+                        (supply_id, 'shipments', shipment_idx, 'delivery_block')
                     )
 
         return driver_index
@@ -43,6 +50,11 @@ def get_value_from_nested_dict(nested_dict: Dict, keys: tuple) -> Any:
 
 
 def get_drivers_deliveries(bitrix_delivery_manager=None, driver_index_builder=None):
+    """
+    Все доставки водителей {driver_id: [delivery_block, ...]} из индекса водителей
+    менеджера, без пересборки вложенной структуры. driver_index_builder не нужен
+    и принимается только ради совместимости.
+    """
     if bitrix_delivery_manager is None:
         webhook_url = os.environ.get("BITRIX_WEBHOOK_URL")
         cache_file = os.environ.get("BITRIX_CACHE_FILE", "bitrix_cache.json")
@@ -51,17 +63,37 @@ def get_drivers_deliveries(bitrix_delivery_manager=None, driver_index_builder=No
             raise ValueError("Не задан BITRIX_WEBHOOK_URL в переменных окружения")
         
         bitrix_delivery_manager =  BitrixDeliveryManager(webhook_url=webhook_url, cache_file=cache_file, force_reload=False)
-    nest_dict = bitrix_delivery_manager.build_nested_structure()
-    if driver_index_builder is None:
-        driver_index_builder = DriverIndexBuilder(bitrix_delivery_manager)
-    driver_index = driver_index_builder.build_driver_index()
+    grouped = bitrix_delivery_manager.get_deliveries_grouped_by_driver(is_active_deliveries=False)
+    return {driver_id: group['deliveries'] for driver_id, group in grouped.items()}
 
-    driver_deliveries = {}
-    for driver_id, deliveries in driver_index.items():
-        driver_deliveries[driver_id] = []
-        for delivery in deliveries:
-            driver_deliveries[driver_id].append(
-                get_value_from_nested_dict(nest_dict, delivery)
-            )
-    
-    return driver_deliveries
\ No newline at end of file
+
+def iter_drivers_deliveries(
+    bitrix_delivery_manager,
+    after: int = None,
+    stage: str = None,
+    modified_since: datetime = None
+) -> Iterator[Tuple[int, List[Dict[str, Any]]]]:
+    """
+    Доставки водителей по возрастанию driver_id, начиная после курсора after.
+    Блоки доставок собираются по одному водителю, когда до него доходит очередь,
+    поэтому страница и поток не требуют сборки ответа по всем водителям.
+    С фильтрами (delivery_block_matches) водители без подходящих доставок пропускаются.
+    """
+    driver_ids = bitrix_delivery_manager.delivery_driver_ids()
+    start = bisect_right(driver_ids, after) if after is not None else 0
+    filtered = stage is not None or modified_since is not None
+    for driver_id in driver_ids[start:]:
+        group = bitrix_delivery_manager.get_deliveries_grouped_by_driver(
+            search_driver_id=driver_id, is_active_deliveries=False
+        )
+        deliveries = group.get('deliveries')
+        if not deliveries:
+            continue
+        if filtered:
+            deliveries = [
+                block for block in deliveries
+                if delivery_block_matches(block, stage=stage, modified_since=modified_since)
+            ]
+            if not deliveries:
+                continue
+        yield driver_id, deliveries
@@ -0,0 +1,136 @@
+from collections.abc import Mapping
+from functools import lru_cache
+from typing import Any, Dict, Iterator, List, Tuple
+
+from webservice.src.change_detector import DRIVER_FIELD
+
+# Файл маршрутного листа доставки ({'url': ...})
+ROUTE_LIST_FIELD = 'ufCrm6_1729602373'
+# Сделка, связанная с поставкой
+SUPPLY_DEAL_FIELD = 'UF_CRM_1728985624'
+
+DEAL_FIELDS = (
+    'ID', 'TITLE', 'STAGE_ID', 'CATEGORY_ID', 'DATE_CREATE', 'DATE_MODIFY',
+    'ASSIGNED_BY_ID', 'OPPORTUNITY', 'CURRENCY_ID', 'COMPANY_ID', 'CONTACT_ID'
+)
+ITEM_FIELDS = (
+    'id', 'title', 'stageId', 'categoryId', 'createdTime', 'updatedTime', 'assignedById'
+)
+
+# Поля, которые сервис действительно использует, по типам сущностей.
+# Они же уходят в select запросов к Bitrix и только они хранятся в кэше.
+ENTITY_FIELDS: Dict[str, Tuple[str, ...]] = {
+    'supply': DEAL_FIELDS + (SUPPLY_DEAL_FIELD,),
+    'deal': DEAL_FIELDS,
+    # PHONE приходит списком и хранится первым номером, PHONES - все номера
+    'contact': ('ID', 'NAME', 'SECOND_NAME', 'LAST_NAME', 'PHONE', 'PHONES', 'DATE_MODIFY'),
+    'shipment': ITEM_FIELDS + ('parentId2',),
+    # product_rows - товары внутри доставки в кэшах прежнего формата
+    'delivery': ITEM_FIELDS + ('parentId1040', DRIVER_FIELD, ROUTE_LIST_FIELD, 'product_rows'),
+    'purchase': ITEM_FIELDS + ('parentId1040',),
+    'loading': ITEM_FIELDS + ('parentId1048',),
+    'unloading': ITEM_FIELDS + ('parentId1048',),
+    'nacladnaya': ITEM_FIELDS + ('parentId1048',),
+    'doverennost': ITEM_FIELDS + ('parentId1048',),
+}
+
+# Поля, которые сервис вычисляет сам и не запрашивает у Bitrix
+_COMPUTED_FIELDS = {'PHONES', 'product_rows'}
+
+# select без проекции (сырой режим)
+RAW_SELECT: Dict[str, List[str]] = {
+    'contact': ["*", "PHONE", "EMAIL"],
+}
+DEFAULT_RAW_SELECT = ["*", "UF_*"]
+
+_ABSENT = object()
+
+
+class Record(Mapping):
+    """
+    Компактная неизменяемая запись сущности: значения полей схемы в кортеже,
+    имена полей общие для всех записей типа. Ведёт себя как словарь только
+    для чтения; поля, которых не было в исходных данных, в записи отсутствуют.
+    """
+    __slots__ = ('_values',)
+    _fields: Tuple[str, ...] = ()
+    _index: Dict[str, int] = {}
+
+    def __init__(self, values: Tuple[Any, ...]):
+        self._values = values
+
+    @classmethod
+    def from_dict(cls, item: Mapping) -> 'Record':
+        return cls(tuple(item.get(field, _ABSENT) for field in cls._fields))
+
+    def __getitem__(self, key: str) -> Any:
+        idx = self._index.get(key)
+        if idx is None or self._values[idx] is _ABSENT:
+            raise KeyError(key)
+        return self._values[idx]
+
+    def __iter__(self) -> Iterator[str]:
+        return (field for field, value in zip(self._fields, self._values) if value is not _ABSENT)
+
+    def __len__(self) -> int:
+        return sum(1 for value in self._values if value is not _ABSENT)
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({dict(self)!r})"
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(self)
+
+
+@lru_cache(maxsize=None)
+def record_class(name: str) -> type:
+    fields = ENTITY_FIELDS[name]
+    return type(f"{name.title()}Record", (Record,), {
+        '__slots__': (),
+        '_fields': fields,
+        '_index': {field: idx for idx, field in enumerate(fields)},
+    })
+
+
+def compact(name: str, item: Any) -> Any:
+    """
+    Запись типа name по схеме ENTITY_FIELDS; типы без схемы
+    (маршрутные листы, товары) возвращаются как есть.
+    """
+    if name not in ENTITY_FIELDS or item is None:
+        return item
+    cls = record_class(name)
+    if type(item) is cls:
+        return item
+    return cls.from_dict(item)
+
+
+def compact_items(name: str, items: Dict[int, Any]) -> Dict[int, Any]:
+    if name not in ENTITY_FIELDS:
+        return items
+    return {item_id: compact(name, item) for item_id, item in items.items()}
+
+
+def select_fields(*names: str, raw: bool = False) -> List[str]:
+    """
+    select для списочных методов Bitrix: объединение полей схемы типов names
+    или ["*", "UF_*"] в сыром режиме.
+    """
+    if raw:
+        return list(RAW_SELECT.get(names[0], DEFAULT_RAW_SELECT))
+    fields = []
+    for name in names:
+        fields.extend(
+            field for field in ENTITY_FIELDS[name]
+            if field not in _COMPUTED_FIELDS and field not in fields
+        )
+    return fields
+
+
+def jsonable(obj: Any) -> Any:
+    """
+    default для json/orjson: записи сериализуются как словари.
+    """
+    if isinstance(obj, Mapping):
+        return dict(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
@@ -0,0 +1,95 @@
+import logging
+import threading
+import traceback
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List
+
+
+@dataclass
+class Job:
+    id: str
+    kind: str
+    status: str = 'pending'  # pending | running | done | failed
+    progress: Dict[str, Any] = field(default_factory=dict)
+    started_at: datetime | None = None
+    finished_at: datetime | None = None
+    error: str | None = None
+    _finished: threading.Event = field(default_factory=threading.Event, repr=False, compare=False)
+
+    def report(self, stage: str, **info):
+        self.progress = {'stage': stage, **info}
+
+    def wait(self, timeout: float = None) -> bool:
+        return self._finished.wait(timeout)
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'progress': dict(self.progress),
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+            'error': self.error
+        }
+        if self.started_at is not None:
+            end = self.finished_at or datetime.now(timezone.utc)
+            data['duration'] = (end - self.started_at).total_seconds()
+        return data
+
+
+class JobRunner:
+    """
+    Фоновые задачи (загрузка, обновление кэша) в отдельных потоках,
+    чтобы долгие синхронные вызовы Bitrix не блокировали event loop.
+    Одновременно выполняется не больше одной задачи каждого вида:
+    повторный запуск возвращает уже идущую задачу.
+    """
+    def __init__(self, max_history: int = 50):
+        self.max_history = max_history
+        self._jobs: 'OrderedDict[str, Job]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def start(self, kind: str, func: Callable[[Job], Any]) -> Job:
+        with self._lock:
+            for job in self._jobs.values():
+                if job.kind == kind and job.status in ('pending', 'running'):
+                    return job
+            job = Job(id=uuid.uuid4().hex, kind=kind)
+            self._jobs[job.id] = job
+            while len(self._jobs) > self.max_history:
+                self._jobs.popitem(last=False)
+
+        threading.Thread(target=self._run, args=(job, func), name=f"job-{kind}", daemon=True).start()
+        return job
+
+    def _run(self, job: Job, func: Callable[[Job], Any]):
+        job.status = 'running'
+        job.started_at = datetime.now(timezone.utc)
+        try:
+            func(job)
+            job.status = 'done'
+        except Exception as e:
+            job.status = 'failed'
+            job.error = str(e)
+            logging.error(f"Задача {job.kind} {job.id} завершилась с ошибкой: {e}\n{traceback.format_exc()}")
+        finally:
+            job.finished_at = datetime.now(timezone.utc)
+            job._finished.set()
+
+    def get(self, job_id: str) -> Job | None:
+        return self._jobs.get(job_id)
+
+    def list(self) -> List[Job]:
+        with self._lock:
+            return list(reversed(self._jobs.values()))
+
+    def running(self, kind: str) -> Job | None:
+        with self._lock:
+            return next(
+                (job for job in self._jobs.values() if job.kind == kind and job.status in ('pending', 'running')),
+                None
+            )
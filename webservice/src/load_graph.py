@@ -0,0 +1,56 @@
+import logging
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List
+
+
+@dataclass
+class Stage:
+    name: str
+    func: Callable[[], None]
+    deps: List[str] = field(default_factory=list)
+
+
+def run_stage_graph(
+    stages: List[Stage],
+    max_workers: int = 4,
+    on_stage_done: Callable[[str, int, int], None] = None
+):
+    """
+    Выполняет граф стадий загрузки: стадия запускается, как только завершены
+    все её зависимости, независимые стадии идут параллельно (не больше max_workers).
+    Первая упавшая стадия прерывает загрузку, её исключение пробрасывается.
+    on_stage_done(name, done, total) вызывается после каждой завершённой стадии.
+    """
+    by_name: Dict[str, Stage] = {stage.name: stage for stage in stages}
+    for stage in stages:
+        unknown = [dep for dep in stage.deps if dep not in by_name]
+        if unknown:
+            raise ValueError(f"Стадия {stage.name} зависит от неизвестных стадий: {unknown}")
+
+    done: set = set()
+    running: Dict[Future, str] = {}
+    waiting = list(stages)
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="bitrix-load") as executor:
+        while waiting or running:
+            ready = [stage for stage in waiting if all(dep in done for dep in stage.deps)]
+            for stage in ready:
+                waiting.remove(stage)
+                running[executor.submit(stage.func)] = stage.name
+
+            if not running:
+                raise ValueError(f"Циклическая зависимость между стадиями: {[s.name for s in waiting]}")
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                error = future.exception()
+                if error is not None:
+                    for pending in running:
+                        pending.cancel()
+                    logging.error(f"Стадия загрузки {name} завершилась с ошибкой: {error}")
+                    raise error
+                done.add(name)
+                if on_stage_done is not None:
+                    on_stage_done(name, len(done), len(stages))
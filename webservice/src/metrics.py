@@ -0,0 +1,280 @@
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Sequence, Tuple
+
+# Границы корзин гистограмм длительности по умолчанию, сек
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+Labels = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)) + '}'
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    """
+    Метрика с метками в формате Prometheus. Значения по наборам меток
+    хранятся в словаре; методы без labels() пишут в набор без меток.
+    """
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values) -> '_Bound':
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name}: ожидаются метки {self.labelnames}, получено {values}")
+        return _Bound(self, tuple(str(value) for value in values))
+
+    def _samples(self) -> Iterator[Tuple[str, Labels, Sequence[str], float]]:
+        with self._lock:
+            items = list(self._values.items())
+        for labels, value in items:
+            yield self.name, labels, self.labelnames, value
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for name, labels, labelnames, value in self._samples():
+            lines.append(f'{name}{_format_labels(labelnames, labels)} {_format_value(value)}')
+        return lines
+
+
+class _Bound:
+    """
+    Метрика с зафиксированными значениями меток: metric.labels(...).inc().
+    """
+    def __init__(self, metric: Metric, labels: Labels):
+        self._metric = metric
+        self._labels = labels
+
+    def __getattr__(self, name: str):
+        method = getattr(self._metric, '_' + name)
+        return lambda *args, **kwargs: method(self._labels, *args, **kwargs)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def _inc(self, labels: Labels, amount: float = 1.0):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def inc(self, amount: float = 1.0):
+        self._inc((), amount)
+
+
+class Gauge(Metric):
+    """
+    Текущее значение. collect() (если задан) вызывается при каждой выдаче
+    метрик и возвращает {значения меток: значение} - для величин, которые
+    дешевле прочитать, чем отслеживать (размеры кэша).
+    """
+    type = 'gauge'
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        collect: Callable[[], Dict[Labels, float]] = None
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.collect = collect
+
+    def _set(self, labels: Labels, value: float):
+        with self._lock:
+            self._values[labels] = value
+
+    def _inc(self, labels: Labels, amount: float = 1.0):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def set(self, value: float):
+        self._set((), value)
+
+    def _samples(self):
+        if self.collect is not None:
+            with self._lock:
+                self._values = {tuple(str(v) for v in labels): value for labels, value in self.collect().items()}
+        return super()._samples()
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # Значения меток -> (счётчики корзин, сумма, количество)
+        self._observations: Dict[Labels, Tuple[List[int], float, int]] = {}
+
+    def _observe(self, labels: Labels, value: float):
+        with self._lock:
+            counts, total, count = self._observations.get(labels) or ([0] * len(self.buckets), 0.0, 0)
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[idx] += 1
+                    break
+            self._observations[labels] = (counts, total + value, count + 1)
+
+    def observe(self, value: float):
+        self._observe((), value)
+
+    @contextmanager
+    def _time(self, labels: Labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._observe(labels, time.perf_counter() - started)
+
+    def time(self):
+        return self._time(())
+
+    def _samples(self):
+        with self._lock:
+            items = [(labels, list(counts), total, count) for labels, (counts, total, count) in self._observations.items()]
+        bucket_names = self.labelnames + ('le',)
+        for labels, counts, total, count in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield f'{self.name}_bucket', labels + (_format_value(bound),), bucket_names, cumulative
+            yield f'{self.name}_sum', labels, self.labelnames, total
+            yield f'{self.name}_count', labels, self.labelnames, count
+
+
+class Registry:
+    """
+    Набор метрик процесса и их выдача в текстовом формате Prometheus (/metrics).
+    """
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Метрика {metric.name} уже зарегистрирована")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = (), collect=None) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames, collect=collect))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets=buckets))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                lines.append(f'# {metric.name}: ошибка сбора: {_escape(str(e))}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+# --- Вызовы Bitrix ---
+BITRIX_REQUESTS = REGISTRY.counter(
+    'bitrix_requests_total', 'HTTP-вызовы Bitrix REST по методу и исходу', ['method', 'outcome']
+)
+BITRIX_REQUEST_SECONDS = REGISTRY.histogram(
+    'bitrix_request_duration_seconds', 'Длительность HTTP-вызова Bitrix REST', ['method']
+)
+BITRIX_RATE_LIMIT_WAIT_SECONDS = REGISTRY.counter(
+    'bitrix_rate_limit_wait_seconds_total', 'Время ожидания квоты запросов в клиенте'
+)
+BITRIX_BATCH_COMMANDS = REGISTRY.counter(
+    'bitrix_batch_commands_total', 'Команды внутри batch по методу', ['method']
+)
+BITRIX_COMMAND_ERRORS = REGISTRY.counter(
+    'bitrix_command_errors_total', 'Ошибки команд Bitrix (в том числе внутри batch)', ['method', 'error']
+)
+BITRIX_PAGES = REGISTRY.histogram(
+    'bitrix_pagination_pages', 'Страниц на одну постраничную выгрузку', ['method', 'mode'],
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+)
+
+# --- Синхронизация ---
+SYNC_SECONDS = REGISTRY.histogram(
+    'bitrix_sync_duration_seconds', 'Длительность полной загрузки и дельта-обновления', ['operation']
+)
+SYNC_RUNS = REGISTRY.counter(
+    'bitrix_sync_runs_total', 'Запуски синхронизации по исходу', ['operation', 'status']
+)
+SYNC_STAGE_SECONDS = REGISTRY.histogram(
+    'bitrix_sync_stage_duration_seconds', 'Длительность стадий загрузки и обновления', ['operation', 'stage']
+)
+SYNC_STAGE_ERRORS = REGISTRY.counter(
+    'bitrix_sync_stage_errors_total', 'Стадии синхронизации, завершившиеся ошибкой', ['operation', 'stage']
+)
+SYNC_LAST_SUCCESS = REGISTRY.gauge(
+    'bitrix_sync_last_success_timestamp_seconds', 'Время последней успешной синхронизации (unix)', ['operation']
+)
+
+# --- HTTP API ---
+HTTP_REQUEST_SECONDS = REGISTRY.histogram(
+    'http_request_duration_seconds', 'Длительность обработки запросов к API', ['route', 'method', 'status']
+)
+
+
+@contextmanager
+def track_stage(operation: str, stage: str):
+    """
+    Замеряет стадию синхронизации: длительность и, при исключении, счётчик ошибок.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        SYNC_STAGE_ERRORS.labels(operation, stage).inc()
+        raise
+    finally:
+        SYNC_STAGE_SECONDS.labels(operation, stage).observe(time.perf_counter() - started)
+
+
+@contextmanager
+def track_sync(operation: str):
+    """
+    Замеряет запуск синхронизации целиком и отмечает время последнего успеха.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        SYNC_RUNS.labels(operation, 'failed').inc()
+        raise
+    else:
+        SYNC_RUNS.labels(operation, 'done').inc()
+        SYNC_LAST_SUCCESS.labels(operation).set(time.time())
+    finally:
+        SYNC_SECONDS.labels(operation).observe(time.perf_counter() - started)
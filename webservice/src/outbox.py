@@ -0,0 +1,210 @@
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from typing import Any, Dict, List
+
+import requests
+
+N8N_URLS = [
+    'https://n8n.glavsnabstroymsk.ru/webhook-test/send_information_about_new_deliveries',
+    'https://n8n.glavsnabstroymsk.ru/webhook/send_information_about_new_deliveries',
+]
+
+
+class NotificationOutbox:
+    """
+    Надёжная очередь уведомлений n8n о доставках (SQLite).
+    Ключ идемпотентности - (delivery_id, driver_id, mode, переход): повторная
+    постановка того же перехода, в том числе после перезапуска, игнорируется,
+    а новый переход (доставку вернули на стадию, водителя назначили снова)
+    даёт новое уведомление. Переход задаётся updatedTime доставки.
+    Записи, исчерпавшие попытки, остаются в статусе failed: их видно
+    через failed() и можно вернуть в очередь requeue_failed(). Фоновый поток
+    забирает пачки готовых к отправке записей, отправляет их параллельно
+    (не больше max_concurrency) и повторяет неудачные с экспоненциальной задержкой.
+    """
+    def __init__(
+        self,
+        path: str,
+        urls: List[str] = None,
+        batch_size: int = 20,
+        max_concurrency: int = 4,
+        max_attempts: int = 8,
+        backoff_base: float = 5.0,
+        backoff_max: float = 600.0,
+        poll_interval: float = 2.0,
+        timeout: float = 15.0
+    ):
+        self.path = path
+        self.urls = urls or N8N_URLS
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.session = requests.Session()
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+        self._thread: threading.Thread | None = None
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS notifications ("
+                " key TEXT PRIMARY KEY,"
+                " delivery_id INTEGER NOT NULL,"
+                " driver_id INTEGER,"
+                " mode TEXT NOT NULL,"
+                " status TEXT NOT NULL DEFAULT 'pending',"
+                " attempts INTEGER NOT NULL DEFAULT 0,"
+                " next_attempt_at REAL NOT NULL,"
+                " created_at REAL NOT NULL,"
+                " sent_at REAL,"
+                " last_error TEXT)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS notifications_due ON notifications (status, next_attempt_at)")
+
+    @classmethod
+    def from_env(cls, cache_file: str) -> 'NotificationOutbox':
+        path = os.environ.get("BITRIX_OUTBOX_FILE") or os.path.splitext(cache_file)[0] + ".outbox.sqlite3"
+        urls = [url for url in os.environ.get("BITRIX_N8N_URLS", "").split(",") if url]
+        return cls(path, urls=urls or None)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def enqueue(self, delivery_id: int, driver_id: int | None, mode: str, transition: str = None) -> bool:
+        """
+        Ставит уведомление в очередь. False, если этот переход уже был поставлен.
+        """
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO notifications (key, delivery_id, driver_id, mode, next_attempt_at, created_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (f"{delivery_id}:{driver_id}:{mode}:{transition or ''}", delivery_id, driver_id, mode, now, now)
+            )
+        added = cursor.rowcount > 0
+        if added:
+            self._wakeup.set()
+        return added
+
+    def _send(self, row: Dict[str, Any]) -> str | None:
+        payload = {"delivery_id": row['delivery_id'], "driver_id": row['driver_id'], 'mode': row['mode']}
+        error = None
+        for url in self.urls:
+            try:
+                response = self.session.post(url, json=payload, timeout=self.timeout)
+                if response.ok:
+                    logging.info(f"Доставка {row['delivery_id']} {row['driver_id']} отправлена в n8n {response.text}")
+                    return None
+                error = f"HTTP {response.status_code} от {url}"
+            except Exception as e:
+                error = f"{url}: {e}"
+        return error
+
+    def drain_once(self) -> int:
+        """
+        Отправляет одну пачку готовых уведомлений, возвращает её размер.
+        """
+        now = time.time()
+        with closing(self._connect()) as conn:
+            conn.row_factory = sqlite3.Row
+            rows = [dict(row) for row in conn.execute(
+                "SELECT key, delivery_id, driver_id, mode, attempts FROM notifications"
+                " WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY next_attempt_at LIMIT ?",
+                (now, self.batch_size)
+            )]
+        if not rows:
+            return 0
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            errors = list(executor.map(self._send, rows))
+
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            for row, error in zip(rows, errors):
+                if error is None:
+                    conn.execute(
+                        "UPDATE notifications SET status = 'sent', sent_at = ?, attempts = attempts + 1, last_error = NULL"
+                        " WHERE key = ?", (now, row['key'])
+                    )
+                    continue
+                attempts = row['attempts'] + 1
+                delay = min(self.backoff_max, self.backoff_base * 2 ** (attempts - 1)) * (0.5 + random.random() / 2)
+                status = 'failed' if attempts >= self.max_attempts else 'pending'
+                conn.execute(
+                    "UPDATE notifications SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ?"
+                    " WHERE key = ?", (status, attempts, now + delay, error, row['key'])
+                )
+                if status == 'failed':
+                    logging.error(f"Уведомление {row['key']} не отправлено за {attempts} попыток: {error}")
+                else:
+                    logging.warning(f"Не удалось отправить уведомление {row['key']} (попытка {attempts}): {error}")
+        return len(rows)
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                if self.drain_once():
+                    continue
+            except Exception as e:
+                logging.error(f"Ошибка обработки очереди уведомлений: {e}")
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="n8n-outbox", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def failed(self, limit: int = 100) -> List[Dict[str, Any]]:
+        """
+        Уведомления, исчерпавшие попытки, новые первыми.
+        """
+        with closing(self._connect()) as conn:
+            conn.row_factory = sqlite3.Row
+            return [dict(row) for row in conn.execute(
+                "SELECT key, delivery_id, driver_id, mode, attempts, created_at, last_error FROM notifications"
+                " WHERE status = 'failed' ORDER BY created_at DESC LIMIT ?", (limit,)
+            )]
+
+    def requeue_failed(self, keys: List[str] = None) -> int:
+        """
+        Возвращает в очередь failed-уведомления (все или с ключами keys) с обнулённым
+        счётчиком попыток. Возвращает число возвращённых записей.
+        """
+        now = time.time()
+        query = "UPDATE notifications SET status = 'pending', attempts = 0, next_attempt_at = ? WHERE status = 'failed'"
+        params: list = [now]
+        if keys is not None:
+            if not keys:
+                return 0
+            query += f" AND key IN ({', '.join('?' * len(keys))})"
+            params.extend(keys)
+        with closing(self._connect()) as conn, conn:
+            requeued = conn.execute(query, params).rowcount
+        if requeued:
+            self._wakeup.set()
+        return requeued
+
+    def stats(self) -> Dict[str, int]:
+        with closing(self._connect()) as conn:
+            return {status: count for status, count in conn.execute(
+                "SELECT status, COUNT(*) FROM notifications GROUP BY status"
+            )}
@@ -0,0 +1,59 @@
+import hashlib
+import json
+from typing import Any, Callable, Dict, Tuple
+
+from webservice.src.entity_schema import jsonable
+from webservice.src.ttl_cache import TTLCache
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _default(obj: Any) -> Any:
+    try:
+        return jsonable(obj)
+    except TypeError:
+        return str(obj)
+
+
+def dumps_response(data: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS, default=_default)
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"), default=_default).encode("utf-8")
+
+
+class ResponseCache:
+    """
+    Сериализованные ответы тяжёлых эндпоинтов по ключу (эндпоинт, параметры, версия данных).
+    Пока версия данных менеджера не изменилась, ответ не пересобирается,
+    а клиент с совпавшим If-None-Match получает 304 вообще без тела.
+    """
+    def __init__(self, maxsize: int = 64, ttl: float = 60 * 60):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    @staticmethod
+    def etag(endpoint: str, params: Dict[str, Any], version: str) -> str:
+        key = json.dumps([endpoint, params, version], sort_keys=True, default=str)
+        return '"' + hashlib.sha1(key.encode("utf-8")).hexdigest()[:20] + '"'
+
+    def get_or_build(
+        self,
+        endpoint: str,
+        params: Dict[str, Any],
+        version: str,
+        build: Callable[[], Any]
+    ) -> Tuple[str, bytes]:
+        """
+        Возвращает (etag, тело ответа), собирая тело через build() только при промахе.
+        """
+        etag = self.etag(endpoint, params, version)
+        body = self._cache.get(etag)
+        if body is None:
+            body = dumps_response(build())
+            self._cache.set(etag, body)
+        return etag, body
+
+    def clear(self):
+        self._cache.clear()
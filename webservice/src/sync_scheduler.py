@@ -0,0 +1,96 @@
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict
+
+from webservice.src.jobs import Job, JobRunner
+
+
+class ScheduledTask:
+    def __init__(self, kind: str, func: Callable[[Job], None], interval: float):
+        self.kind = kind
+        self.func = func
+        self.interval = interval
+        self.next_run = time.monotonic() + interval
+        self.last_run_at: datetime | None = None
+        self.last_duration: float | None = None
+        self.last_status: str | None = None
+        self.last_error: str | None = None
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            'interval': self.interval,
+            'last_run_at': self.last_run_at.isoformat() if self.last_run_at else None,
+            'last_duration': self.last_duration,
+            'last_status': self.last_status,
+            'last_error': self.last_error,
+            'next_run_in': max(0.0, self.next_run - time.monotonic()) if self.interval > 0 else None
+        }
+
+
+class SyncScheduler:
+    """
+    Фоновый планировщик синхронизации кэша с Bitrix внутри приложения:
+    частые дельта-обновления (refresh_updates) и редкая полная сверка (загрузка
+    с нуля). Задачи запускаются через JobRunner под теми же видами, что и ручные
+    /refresh и /load, поэтому не пересекаются с ними. Интервал 0 отключает задачу.
+    """
+    def __init__(
+        self,
+        jobs: JobRunner,
+        delta: Callable[[Job], None],
+        full: Callable[[Job], None],
+        delta_interval: float = 60,
+        full_interval: float = 6 * 60 * 60,
+        tick: float = 1.0
+    ):
+        self.jobs = jobs
+        self.tick = tick
+        self.tasks = [
+            ScheduledTask('load', full, full_interval),
+            ScheduledTask('refresh', delta, delta_interval),
+        ]
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="sync-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def _loop(self):
+        while not self._stop.wait(self.tick):
+            # Полная сверка важнее: если подошли обе, дельта подождёт следующего тика
+            for task in self.tasks:
+                if task.interval > 0 and time.monotonic() >= task.next_run:
+                    self._run(task)
+                    break
+
+    def _run(self, task: ScheduledTask):
+        job = self.jobs.start(task.kind, task.func)
+        job.wait()
+        task.last_run_at = job.started_at
+        task.last_duration = (job.finished_at - job.started_at).total_seconds() if job.started_at else None
+        task.last_status = job.status
+        task.last_error = job.error
+        task.next_run = time.monotonic() + task.interval
+        if task.kind == 'load':
+            # После полной сверки дельта не нужна раньше своего интервала
+            for other in self.tasks:
+                other.next_run = max(other.next_run, time.monotonic() + other.interval)
+        logging.info(f"Плановая синхронизация {task.kind}: {job.status} за {task.last_duration} с")
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            'running': self._thread is not None and self._thread.is_alive(),
+            'now': datetime.now(timezone.utc).isoformat(),
+            **{task.kind: task.status() for task in self.tasks}
+        }
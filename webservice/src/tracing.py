@@ -0,0 +1,231 @@
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, List
+
+# Трассировка включается BITRIX_TRACING=1 или через set_enabled (отладочный эндпоинт)
+_enabled = os.environ.get("BITRIX_TRACING", "0") == "1"
+# Последние трассы по видам: частые запросы не вытесняют трассы синхронизации
+TRACE_BUFFER = int(os.environ.get("BITRIX_TRACE_BUFFER", 50))
+_traces: Dict[str, deque] = {}
+_traces_lock = threading.Lock()
+# Виды трасс, следующий запуск которых нужно снять профилировщиком
+_armed_profiles: set = set()
+PROFILE_INTERVAL = float(os.environ.get("BITRIX_PROFILE_INTERVAL", 0.005))
+
+
+class Span:
+    __slots__ = ('name', 'attrs', 'trace', 'start', 'duration', 'error', 'children')
+
+    def __init__(self, name: str, attrs: Dict[str, Any], trace: 'Trace'):
+        self.name = name
+        self.attrs = attrs
+        self.trace = trace
+        self.start = time.perf_counter()
+        self.duration: float | None = None
+        self.error: str | None = None
+        self.children: List['Span'] = []
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'name': self.name,
+            'attrs': self.attrs,
+            'start_ms': round((self.start - self.trace.root.start) * 1000, 3),
+            'duration_ms': round(self.duration * 1000, 3) if self.duration is not None else None,
+            'error': self.error,
+            'children': [child.to_dict() for child in self.children]
+        }
+
+
+class Trace:
+    """
+    Дерево спанов одного запуска синхронизации или запроса к API.
+    threads - потоки, в которых сейчас открыты спаны трассы (их снимает профилировщик).
+    """
+    def __init__(self, kind: str, name: str, attrs: Dict[str, Any]):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.started_at = datetime.now(timezone.utc)
+        self.root = Span(name, attrs, self)
+        self.threads: Counter = Counter()
+        self.profile: Dict[str, int] | None = None
+        self._lock = threading.Lock()
+
+    def enter_thread(self):
+        with self._lock:
+            self.threads[threading.get_ident()] += 1
+
+    def exit_thread(self):
+        with self._lock:
+            ident = threading.get_ident()
+            self.threads[ident] -= 1
+            if self.threads[ident] <= 0:
+                del self.threads[ident]
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'name': self.root.name,
+            'started_at': self.started_at.isoformat(),
+            'duration_ms': round(self.root.duration * 1000, 3) if self.root.duration is not None else None,
+            'error': self.root.error,
+            'profiled': self.profile is not None
+        }
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {**self.summary(), 'root': self.root.to_dict()}
+
+    def folded_stacks(self) -> str:
+        """
+        Профиль в формате folded stacks (flamegraph.pl, speedscope): "кадр;кадр;... число".
+        """
+        return ''.join(f"{stack} {count}\n" for stack, count in sorted((self.profile or {}).items()))
+
+
+_current: ContextVar[Span | None] = ContextVar('bitrix_span', default=None)
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def set_enabled(enabled: bool):
+    global _enabled
+    _enabled = enabled
+
+
+def arm_profile(kind: str):
+    """
+    Снять профилировщиком следующий запуск вида kind (даже при выключенной трассировке).
+    """
+    _armed_profiles.add(kind)
+
+
+def current_span() -> Span | None:
+    return _current.get()
+
+
+class SamplingProfiler:
+    """
+    Сэмплирующий профилировщик: раз в interval снимает стеки потоков трассы
+    (sys._current_frames) и считает одинаковые стеки.
+    """
+    def __init__(self, trace: Trace, interval: float = PROFILE_INTERVAL):
+        self.trace = trace
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="trace-profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self) -> Dict[str, int]:
+        self._stop.set()
+        self._thread.join()
+        return dict(self.stacks)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            with self.trace._lock:
+                idents = list(self.trace.threads)
+            frames = sys._current_frames()
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident in idents:
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[';'.join(reversed(stack))] += 1
+
+
+@contextmanager
+def trace(kind: str, name: str = None, **attrs) -> Iterator[Span | None]:
+    """
+    Корневой спан новой трассы (запуск синхронизации, запрос). Законченная трасса
+    попадает в кольцевой буфер. Без включённой трассировки и взведённого профиля
+    ничего не записывается. Внутри уже идущей трассы работает как span.
+    """
+    if _current.get() is not None:
+        with span(name or kind, **attrs) as child:
+            yield child
+        return
+    profile = kind in _armed_profiles
+    if not (_enabled or profile):
+        yield None
+        return
+    _armed_profiles.discard(kind)
+
+    record = Trace(kind, name or kind, attrs)
+    profiler = SamplingProfiler(record) if profile else None
+    token = _current.set(record.root)
+    record.enter_thread()
+    if profiler is not None:
+        profiler.start()
+    try:
+        yield record.root
+    except BaseException as e:
+        record.root.error = repr(e)
+        raise
+    finally:
+        record.root.duration = time.perf_counter() - record.root.start
+        record.exit_thread()
+        _current.reset(token)
+        if profiler is not None:
+            record.profile = profiler.stop()
+        with _traces_lock:
+            _traces.setdefault(kind, deque(maxlen=TRACE_BUFFER)).append(record)
+
+
+@contextmanager
+def span(name: str, parent: Span | None = None, **attrs) -> Iterator[Span | None]:
+    """
+    Дочерний спан текущего (или parent - для кода в другом потоке пула).
+    Вне трассы ничего не делает.
+    """
+    parent = parent or _current.get()
+    if parent is None:
+        yield None
+        return
+    record = Span(name, attrs, parent.trace)
+    parent.children.append(record)
+    token = _current.set(record)
+    parent.trace.enter_thread()
+    try:
+        yield record
+    except BaseException as e:
+        record.error = repr(e)
+        raise
+    finally:
+        record.duration = time.perf_counter() - record.start
+        parent.trace.exit_thread()
+        _current.reset(token)
+
+
+def list_traces(kind: str = None) -> List[Dict[str, Any]]:
+    """
+    Сводки сохранённых трасс (вида kind или всех), новые первыми.
+    """
+    with _traces_lock:
+        records = [record for name, buffer in _traces.items() if kind in (None, name) for record in buffer]
+    return [record.summary() for record in sorted(records, key=lambda record: record.started_at, reverse=True)]
+
+
+def get_trace(trace_id: str) -> Trace | None:
+    with _traces_lock:
+        return next((record for buffer in _traces.values() for record in buffer if record.id == trace_id), None)
@@ -0,0 +1,91 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, List, Tuple
+
+
+class TTLCache:
+    """
+    Ограниченный по размеру кэш с временем жизни записей.
+    При переполнении вытесняются давно не использованные записи (LRU),
+    просроченные записи считаются отсутствующими. Потокобезопасен.
+    Ключи просроченных и вытесненных записей копятся до drain_expired(),
+    а generation растёт при каждом таком удалении - по нему владелец
+    узнаёт, что значения, скопированные из кэша, устарели.
+    """
+    def __init__(self, maxsize: int = 10000, ttl: float = 3600.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.generation = 0
+        self._data: 'OrderedDict[Hashable, Tuple[float, Any]]' = OrderedDict()
+        self._expired: set = set()
+        # Не раньше этого момента истекает хотя бы одна запись
+        self._next_expiry = math.inf
+        self._lock = threading.Lock()
+
+    def _drop(self, key: Hashable):
+        # Вызывается под self._lock
+        del self._data[key]
+        self._expired.add(key)
+        self.generation += 1
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                self._drop(key)
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def __contains__(self, key: Hashable) -> bool:
+        sentinel = object()
+        return self.get(key, sentinel) is not sentinel
+
+    def set(self, key: Hashable, value: Any):
+        with self._lock:
+            expires_at = time.monotonic() + self.ttl
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            self._expired.discard(key)
+            self._next_expiry = min(self._next_expiry, expires_at)
+            while len(self._data) > self.maxsize:
+                self._drop(next(iter(self._data)))
+
+    def expire(self):
+        """
+        Удаляет просроченные записи. Дёшево, пока ни одна запись не истекла.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if now < self._next_expiry:
+                return
+            for key in [key for key, (expires_at, _) in self._data.items() if expires_at <= now]:
+                self._drop(key)
+            self._next_expiry = min((expires_at for expires_at, _ in self._data.values()), default=math.inf)
+
+    def drain_expired(self) -> List[Hashable]:
+        """
+        Ключи записей, просроченных или вытесненных с прошлого вызова.
+        """
+        with self._lock:
+            expired, self._expired = list(self._expired), set()
+            return expired
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.pop(key, None)
+            return default if entry is None else entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._expired.clear()
+            self._next_expiry = math.inf
+
+    def __len__(self) -> int:
+        return len(self._data)